@@ -0,0 +1,117 @@
+import random
+import struct
+
+import numpy as np
+import pytest
+
+from vargtass.game_assets import (
+    FAR_POINTER,
+    NEAR_POINTER,
+    decompress_carmack,
+    decompress_plane,
+    decompress_rlew,
+)
+
+
+def words_to_bytes(words):
+    return struct.pack(f"<{len(words)}H", *words)
+
+
+def make_carmack(rnd: random.Random, max_words: int = 4000):
+    """
+    Returns random Carmack compressed data and what it decompresses to. The
+    expected output is built one word at a time, the way the original game
+    expands it, so back-references that overlap their output repeat words.
+    """
+    data, out = bytearray(), []
+    while len(out) < max_words:
+        r = rnd.random()
+        if out and r < 0.15:
+            n, back = rnd.randint(1, 20), rnd.randint(1, min(255, len(out)))
+            data += bytes([n, NEAR_POINTER, back])
+            for _ in range(n):
+                out.append(out[-back])
+        elif out and r < 0.25:
+            n, offs = rnd.randint(1, 20), rnd.randrange(len(out))
+            data += bytes([n, FAR_POINTER]) + offs.to_bytes(2, "little")
+            for k in range(n):
+                out.append(out[offs + k])
+        elif r < 0.35:
+            # Words with a pointer tag as their high byte are escaped
+            low, tag = rnd.randrange(256), rnd.choice([NEAR_POINTER, FAR_POINTER])
+            data += bytes([0, tag, low])
+            out.append(low | tag << 8)
+        else:
+            word = rnd.randrange(0x10000)
+            if word >> 8 in (NEAR_POINTER, FAR_POINTER):
+                word &= 0xFF
+            data += word.to_bytes(2, "little")
+            out.append(word)
+    return (len(out) * 2).to_bytes(2, "little") + bytes(data), words_to_bytes(out)
+
+
+def make_rlew(rnd: random.Random, tag: int, max_words: int = 4000):
+    """Returns random RLEW compressed data and what it decompresses to"""
+    data, out = [], []
+    while len(out) < max_words:
+        if rnd.random() < 0.2:
+            # Run lengths and values can be the tag too, if it's small enough
+            n = rnd.choice([1, 2, rnd.randint(1, 100)] + [tag] * (tag <= 100))
+            value = rnd.choice([tag, rnd.randrange(0x10000)])
+            data += [tag, n, value]
+            out += [value] * n
+        else:
+            word = rnd.randrange(0x10000)
+            if word == tag:
+                data += [tag, 1, tag]
+            else:
+                data.append(word)
+            out.append(word)
+    return words_to_bytes([len(out) * 2] + data), words_to_bytes(out)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_carmack(seed):
+    data, expected = make_carmack(random.Random(seed))
+    assert decompress_carmack(data) == expected
+
+
+def test_carmack_overlapping_reference():
+    # One word, then a near pointer one word back repeating it three times
+    data = (8).to_bytes(2, "little") + bytes([0x34, 0x12, 3, NEAR_POINTER, 1])
+    assert decompress_carmack(data) == words_to_bytes([0x1234] * 4)
+
+
+def test_carmack_size_mismatch():
+    with pytest.raises(Exception):
+        decompress_carmack((6).to_bytes(2, "little") + bytes([1, 2]))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_rlew(seed):
+    data, expected = make_rlew(random.Random(seed), 7)
+    assert decompress_rlew(data, 7) == expected
+
+
+def test_rlew_size_mismatch():
+    with pytest.raises(Exception):
+        decompress_rlew(words_to_bytes([6, 1, 2]), 0xABCD)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_decompress_plane(seed):
+    rnd = random.Random(seed)
+    rlew, expected = make_rlew(rnd, 0xABCD, 2000)
+
+    # Carmack compress the RLEW data with literal words only
+    carmack = bytearray(len(rlew).to_bytes(2, "little"))
+    for (word,) in struct.iter_unpack("<H", rlew):
+        if word >> 8 in (NEAR_POINTER, FAR_POINTER):
+            carmack += bytes([0, word >> 8, word & 0xFF])
+        else:
+            carmack += word.to_bytes(2, "little")
+
+    out = np.zeros(len(expected) // 2, dtype=np.uint16)
+    plane = decompress_plane(bytes(carmack), 0xABCD, out)
+    assert plane is out
+    assert plane.tobytes() == expected
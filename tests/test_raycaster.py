@@ -0,0 +1,177 @@
+import math
+import random
+import struct
+
+import numpy as np
+import pytest
+
+from vargtass.game_assets import (
+    TILE_SOLID,
+    GameAssets,
+    Level,
+    LevelHeader,
+    Plane0,
+    Plane1,
+    Plane2,
+)
+from vargtass.game_state import GameState
+from vargtass.parallel import ParallelRaycaster
+from vargtass.raycaster import RAY_FIELDS, Raycaster, get_ray_table
+
+SIZE = 32
+FOV = math.pi / 8
+
+
+def make_level(seed: int):
+    """
+    A level with walls around the edges and at random, and a vertical and
+    a horizontal wall with doors in them
+    """
+    rnd = random.Random(seed)
+    floor = 108
+    cells = [
+        rnd.randint(1, 20) if rnd.random() < 0.08 else floor for _ in range(SIZE * SIZE)
+    ]
+    for i in range(SIZE):
+        for x, y in ((i, 0), (i, SIZE - 1), (0, i), (SIZE - 1, i)):
+            cells[y * SIZE + x] = rnd.randint(1, 20)
+
+    for y in range(1, SIZE - 1):
+        cells[y * SIZE + 12] = 3
+    for x in range(13, SIZE - 1):
+        cells[20 * SIZE + x] = 5
+    for y in range(3, SIZE - 2, 5):
+        cells[y * SIZE + 11 : y * SIZE + 14] = [floor, 90, floor]
+    for x in range(15, SIZE - 2, 4):
+        cells[19 * SIZE + x] = cells[21 * SIZE + x] = floor
+        cells[20 * SIZE + x] = 92
+
+    plane0 = struct.pack(f"<{SIZE * SIZE}H", *cells)
+    empty = bytes(SIZE * SIZE * 2)
+    header = LevelHeader(0, 0, 0, 0, 0, 0, SIZE, SIZE, "TEST")
+    return Level(
+        header,
+        Plane0(plane0, SIZE, SIZE),
+        Plane1(empty, SIZE, SIZE),
+        Plane2(empty, SIZE, SIZE),
+    )
+
+
+def make_state(level: Level, rnd: random.Random):
+    """A game state with the doors of the level closed, open and in between"""
+    state = GameState(GameAssets())
+    state.door_positions = np.array(
+        [rnd.choice([0.0, 1.0, rnd.random()]) for _ in range(level.door_count)]
+    )
+    return state
+
+
+def cameras(level: Level, rnd: random.Random, count: int):
+    """Random camera positions and directions outside of walls and doors"""
+    for _ in range(count):
+        while True:
+            x, y = rnd.uniform(1, SIZE - 1), rnd.uniform(1, SIZE - 1)
+            tile = level.get_tile(int(x), int(y))
+            if not tile.is_solid and not tile.is_door:
+                break
+        yield x, y, rnd.uniform(-7, 7)
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("door_is_solid", [False, True])
+def test_cast_frame_matches_raycast(seed, door_is_solid):
+    rnd = random.Random(seed)
+    level = make_level(seed)
+    state = make_state(level, rnd)
+    raycaster = Raycaster()
+
+    for x, y, dir in cameras(level, rnd, 20):
+        hits = raycaster.cast_frame(
+            state, level, x, y, dir, FOV, 64, door_is_solid=door_is_solid
+        )
+        dx, dy = get_ray_table(64, FOV).directions(dir)
+        for i in range(64):
+            hit = Raycaster().raycast(
+                state,
+                level,
+                x,
+                y,
+                math.atan2(dy[i], dx[i]),
+                door_is_solid=door_is_solid,
+            )
+            if hit is None:
+                assert not hits.hit[i]
+                continue
+
+            distance, tx, texture, (hit_x, hit_y), tile = hit
+            assert hits.hit[i]
+            assert hits.distance[i] == pytest.approx(distance, abs=1e-9)
+            assert hits.tx[i] == pytest.approx(tx, abs=1e-9)
+            assert hits.hit_x[i] == pytest.approx(hit_x, abs=1e-9)
+            assert hits.hit_y[i] == pytest.approx(hit_y, abs=1e-9)
+            assert hits.texture[i] == texture
+            assert (hits.tile_x[i], hits.tile_y[i]) == (tile.x, tile.y)
+
+
+def assert_same_hits(a, b):
+    assert np.array_equal(a.hit, b.hit)
+    for field, _ in RAY_FIELDS:
+        assert np.array_equal(getattr(a, field)[a.hit], getattr(b, field)[b.hit])
+    assert sorted(zip(a.door_rays.tolist(), a.door_ids.tolist())) == sorted(
+        zip(b.door_rays.tolist(), b.door_ids.tolist())
+    )
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_skip_empty(seed):
+    rnd = random.Random(seed)
+    level = make_level(seed)
+    state = make_state(level, rnd)
+    skipping, stepping = Raycaster(), Raycaster()
+    stepping.skip_empty = False
+
+    for x, y, dir in cameras(level, rnd, 20):
+        assert_same_hits(
+            skipping.cast_frame(state, level, x, y, dir, FOV, 320),
+            stepping.cast_frame(state, level, x, y, dir, FOV, 320),
+        )
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("column_step", [2, 4, 8])
+def test_sparse_columns(seed, column_step):
+    rnd = random.Random(seed)
+    level = make_level(seed)
+    state = make_state(level, rnd)
+    raycaster = Raycaster()
+
+    for x, y, dir in cameras(level, rnd, 20):
+        sparse = raycaster.cast_frame(
+            state, level, x, y, dir, FOV, 320, column_step=column_step
+        )
+        full = raycaster.cast_frame(state, level, x, y, dir, FOV, 320)
+        assert np.array_equal(sparse.hit, full.hit)
+
+        # The only rays allowed to differ are those that miss the corner of
+        # a closer tile poking in between two samples
+        differ = np.zeros(320, dtype=bool)
+        for field, _ in RAY_FIELDS:
+            differ |= getattr(sparse, field) != getattr(full, field)
+        differ &= full.hit
+        assert np.all(full.distance[differ] < sparse.distance[differ])
+
+
+def test_parallel():
+    rnd = random.Random(0)
+    level = make_level(0)
+    state = make_state(level, rnd)
+
+    with ParallelRaycaster(3) as parallel:
+        for i, (x, y, dir) in enumerate(cameras(level, rnd, 10)):
+            if i == 5:
+                # The workers must pick up changed tiles
+                level.set_tile_kind(int(x) ^ 1, int(y), TILE_SOLID)
+            hits = parallel.cast_frame(state, level, x, y, dir, FOV, 320)
+            expected = Raycaster().cast_frame(state, level, x, y, dir, FOV, 320)
+            assert_same_hits(hits, expected)
+            assert np.array_equal(hits.visible_tiles, expected.visible_tiles)
@@ -11,8 +11,9 @@ if __name__ == "__main__":
     logging.getLogger().setLevel(logging.DEBUG)
 
     assets_path = os.path.join(os.path.dirname(__file__), "..", "assets")
+    cache_root = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
     assets = GameAssets()
-    assets.load(assets_path)
+    assets.load(assets_path, os.path.join(cache_root, "vargtass"))
 
     # run_wall_display(assets)
     # run_sprite_display(assets)
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+# Version of the files stored in the cache. Increment it whenever the arrays
+# that are stored, or the way they are derived from the game files, change.
+CACHE_FORMAT_VERSION = 1
+
+MAGIC = b"VARGTASS"
+
+# Alignment of the arrays in the files
+ALIGNMENT = 64
+
+
+def hash_files(data: Iterable[bytes]):
+    """Content hash of the game files, as a hex string"""
+    h = hashlib.blake2b(digest_size=16)
+    for d in data:
+        h.update(len(d).to_bytes(8, "little"))
+        h.update(d)
+    return h.hexdigest()
+
+
+def _align(offset: int):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class AssetCache:
+    """
+    Directory of arrays decoded from the game files, such as the planes and
+    tile arrays of levels and the palette converted walls and sprites.
+
+    Every entry is one file: the magic bytes, the length of a JSON header
+    with the dtype, shape and offset of each array, the header itself and
+    then the raw arrays. Entries are memory mapped when loaded, so only the
+    pages that are used are read.
+
+    The files are stored in a subdirectory named after the format version
+    and the content hash of the game files, so changed game files or a new
+    format never read stale arrays.
+    """
+
+    path: str
+
+    def __init__(self, root: str, content_hash: str):
+        self.path = os.path.join(root, f"v{CACHE_FORMAT_VERSION}-{content_hash}")
+
+    def load(self, name: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Returns the arrays of an entry, or None if it's not in the cache or
+        can't be read. The arrays are copy-on-write memory maps, so changes to
+        them are never written back.
+        """
+        try:
+            with open(os.path.join(self.path, name), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            if data[:8] != MAGIC:
+                raise ValueError("bad magic")
+            size = int.from_bytes(data[8:16], "little")
+            if 16 + size > len(data):
+                raise ValueError("truncated header")
+            header = json.loads(data[16 : 16 + size])
+            if not isinstance(header, dict) or not header:
+                raise ValueError("bad header")
+            start = _align(16 + size)
+
+            arrays = {}
+            for key, (dtype, shape, offset) in header.items():
+                dtype, shape = np.dtype(dtype), tuple(shape)
+                end = start + offset + dtype.itemsize * int(np.prod(shape))
+                if offset < 0 or end > len(data):
+                    raise ValueError(f"truncated array {key}")
+                arrays[key] = np.ndarray(
+                    shape, dtype=dtype, buffer=data, offset=start + offset
+                )
+            return arrays
+        except (TypeError, ValueError) as e:
+            logging.warning("Ignoring malformed cache entry %s: %s", name, e)
+            return None
+
+    def save(self, name: str, arrays: Dict[str, np.ndarray]):
+        """
+        Store the arrays of an entry. The file is written under a temporary
+        name first and then renamed, so that other processes never see a
+        partial entry. Failing to write it is logged and otherwise ignored.
+        """
+        arrays = {key: np.asarray(a, order="C") for key, a in arrays.items()}
+        header, offset = {}, 0
+        for key, a in arrays.items():
+            header[key] = (a.dtype.str, a.shape, offset)
+            offset = _align(offset + a.nbytes)
+        header = json.dumps(header).encode()
+
+        tmp = None
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=f".{name}-", dir=self.path)
+            with os.fdopen(fd, "wb") as f:
+                f.write(MAGIC + len(header).to_bytes(8, "little") + header)
+                for a in arrays.values():
+                    f.write(bytes(_align(f.tell()) - f.tell()))
+                    f.write(a.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, os.path.join(self.path, name))
+        except OSError as e:
+            logging.warning("Failed to store %s in the cache: %s", name, e)
+            if tmp is not None:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
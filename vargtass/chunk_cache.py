@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from typing import Callable, Collection, Dict, Iterable, Mapping, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class ChunkCache(Mapping[int, T]):
+    """
+    Read-only mapping from chunk index to a decoded chunk, such as a wall or
+    a sprite. Chunks are decoded on first access and kept in a least recently
+    used cache of at most max_items chunks. Chunks that are added directly
+    can't be decoded again, so they are never evicted.
+
+    The indices that can be decoded are given as a collection, which can be
+    another chunk cache that the chunks are derived from.
+    """
+
+    decode: Optional[Callable[[int], T]]
+    max_items: Optional[int]
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(
+        self,
+        decode: Optional[Callable[[int], T]] = None,
+        indices: Collection[int] = (),
+        max_items: Optional[int] = None,
+    ):
+        self.decode = decode
+        self.max_items = max_items
+        self.indices = indices
+        self.pinned: Dict[int, T] = {}
+        self.decoded: "OrderedDict[int, T]" = OrderedDict()
+
+    def add(self, index: int, item: T):
+        self.pinned[index] = item
+        self.decoded.pop(index, None)
+
+    def discard(self, index: int):
+        """Drop a chunk, so that it is decoded again on next access"""
+        self.pinned.pop(index, None)
+        self.decoded.pop(index, None)
+
+    def __getitem__(self, index: int) -> T:
+        try:
+            return self.pinned[index]
+        except KeyError:
+            pass
+
+        try:
+            item = self.decoded[index]
+        except KeyError:
+            if self.decode is None or index not in self.indices:
+                raise
+            self.misses += 1
+            item = self.decode(index)
+            self.decoded[index] = item
+            if self.max_items is not None and len(self.decoded) > self.max_items:
+                self.decoded.popitem(last=False)
+            return item
+
+        self.hits += 1
+        self.decoded.move_to_end(index)
+        return item
+
+    def __contains__(self, index) -> bool:
+        return index in self.pinned or index in self.indices
+
+    def __iter__(self):
+        return iter(sorted(set(self.indices).union(self.pinned)))
+
+    def __len__(self):
+        return len(set(self.indices).union(self.pinned))
+
+    def prefetch(self, indices: Iterable[int]):
+        """Decode the given chunks ahead of use, skipping unknown indices"""
+        for index in indices:
+            if index in self:
+                self[index]
+
+    def clear(self):
+        """Drop every decoded chunk that can be decoded again"""
+        self.decoded.clear()
@@ -1,13 +1,18 @@
-from math import acos, atan, atan2, cos, floor, fmod, pi, sin, sqrt
-from typing import Dict, Optional, Set, Tuple
+from math import atan, cos, floor, fmod, pi, sin, sqrt, tan
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
 import pygame
 from array import array
 from vargtass.game_state import GameState
-from vargtass.raycaster import Raycaster
+from vargtass.raycaster import HitCache, Raycaster, get_ray_table
+from vargtass.surface_cache import SurfaceCache, quantize_size
 
-from vargtass.utils import Vec2, chunks, d2r, r2d, rotate
+from vargtass.utils import chunks, d2r, r2d, rotate
 
-from .game_assets import GameAssets, Level
+from .game_assets import TILE_SOLID, GameAssets, Level, Media
+
+# Hits of the previous frame rendered by render_3d
+_hit_cache = HitCache()
 
 
 def render_player(screen: pygame.Surface, x: float, y: float, dir: float):
@@ -19,7 +24,7 @@ def render_player(screen: pygame.Surface, x: float, y: float, dir: float):
 
 
 def draw_column(
-    screen: pygame.Surface, wall: list[int], x: int, top: int, bottom: int, tx: float
+    screen: pygame.Surface, wall: np.ndarray, x: int, top: int, bottom: int, tx: float
 ):
     assert tx >= 0 and tx < 1.0
     tx = int(tx * 64)
@@ -45,10 +50,154 @@ def draw_column(
 
         # screen.set_at((x, y), c)
 
-        screen.set_at((x, y), wall[int(tx) * 64 + int(ty)])
+        screen.set_at((x, y), int(wall[int(tx) * 64 + int(ty)]))
         ty += tstep
 
 
+def draw_walls(
+    screen: pygame.Surface,
+    media: Media,
+    x: np.ndarray,
+    top: np.ndarray,
+    bottom: np.ndarray,
+    tx: np.ndarray,
+    texture: np.ndarray,
+):
+    """
+    Draw many wall columns at once, straight into the pixels of the screen.
+    The arguments are arrays with one entry per column, and each column is
+    drawn exactly like draw_column() would draw it.
+    """
+    if len(x) == 0:
+        return
+
+    sh = screen.get_height()
+    tstep = 64 / np.maximum(bottom - top, 1)
+
+    # Texture rows, accumulated one screen row at a time like in draw_column()
+    # so that the rounding is the same
+    start = np.maximum(top, 0)
+    rows = np.minimum(bottom, sh) - start
+    ty = np.repeat(tstep[:, None], max(rows.max(), 1), axis=1)
+    ty[:, 0] = np.where(top < 0, tstep * -top, 0.0)
+    np.add.accumulate(ty, axis=1, out=ty)
+
+    index = (tx * 64).astype(np.intp)[:, None] * 64 + ty.astype(np.intp)
+    np.minimum(index, 64 * 64 - 1, out=index)
+
+    inside = np.arange(ty.shape[1]) < rows[:, None]
+    column, row = np.nonzero(inside)
+    # The atlas is sampled directly, so make sure every wall in it is decoded
+    media.walls.prefetch(np.unique(texture).tolist())
+    walls = media.wall_atlas.reshape(-1, 64 * 64)
+    pixels = pygame.surfarray.pixels2d(screen)
+    pixels[x[column], start[column] + row] = walls[texture[column], index[column, row]]
+    del pixels
+
+
+def draw_wall_spans(
+    screen: pygame.Surface,
+    media: Media,
+    strips: SurfaceCache,
+    x: List[int],
+    top: List[int],
+    bottom: List[int],
+    tx: List[float],
+    texture: List[int],
+):
+    """
+    Draw wall columns with blits of texture columns, pre-scaled to quantized
+    heights and kept in a cache. Runs of adjacent columns with the same
+    texture and quantized height form a span, which shares one top edge and
+    is drawn with a single Surface.blits() call. The result is close to
+    draw_column(), but not pixel-identical.
+
+    Strips of walls that reach past the top or bottom of the screen only
+    hold the rows that are visible, so that walls right in front of the
+    camera don't make strips many times the height of the screen.
+    """
+
+    def make_strip(wall: pygame.Surface, column: int, size: int):
+        return lambda: pygame.transform.scale(
+            wall.subsurface((column, 0, 1, 64)), (1, size)
+        )
+
+    def make_clipped_strip(tex: int, column: int, size: int, skip: int, rows: int):
+        def make():
+            texels = media.walls[tex][column * 64 : column * 64 + 64]
+            strip = pygame.Surface((1, rows))
+            ty = np.arange(skip, skip + rows) * 64 // size
+            pygame.surfarray.blit_array(strip, texels[ty][None, :])
+            return strip
+
+        return make
+
+    sh = screen.get_height()
+    i = 0
+    while i < len(x):
+        height = bottom[i] - top[i]
+        size = quantize_size(height)
+        tex = texture[i]
+        y = top[i] + (height - size) // 2
+        y0, y1 = max(y, 0), min(y + size, sh)
+        clipped = y0 > y or y1 < y + size
+
+        blits = []
+        wall = media.get_wall_surface(tex)
+        while (
+            i < len(x)
+            and texture[i] == tex
+            and quantize_size(bottom[i] - top[i]) == size
+            and (not blits or x[i] == x[i - 1] + 1)
+        ):
+            if wall and y1 > y0:
+                column = int(tx[i] * 64)
+                if clipped:
+                    strip = strips.get(
+                        (tex, column, size, y0 - y, y1 - y0),
+                        make_clipped_strip(tex, column, size, y0 - y, y1 - y0),
+                    )
+                else:
+                    strip = strips.get(
+                        (tex, column, size), make_strip(wall, column, size)
+                    )
+                blits.append((strip, (x[i], y0)))
+            i += 1
+
+        screen.blits(blits, doreturn=False)
+
+
+def draw_sprite(
+    screen: pygame.Surface,
+    surf: pygame.Surface,
+    x: int,
+    y: int,
+    z: float,
+    zbuf: np.ndarray,
+):
+    """
+    Blit a pre-scaled sprite at x, y, clipped to the screen columns where the
+    z-buffer has no wall closer than z.
+    """
+    x0, x1 = max(x, 0), min(x + surf.get_width(), screen.get_width())
+    if x0 >= x1:
+        return
+
+    z_columns = zbuf[x0:x1]
+    visible = ~((z_columns > 0) & (z_columns <= z))
+
+    # Start and end of each run of visible columns
+    edges = np.flatnonzero(np.diff(visible, prepend=False, append=False))
+    h = surf.get_height()
+    screen.blits(
+        [
+            (surf, (x0 + a, y), (x0 + a - x, 0, b - a, h))
+            for a, b in zip(edges[0::2].tolist(), edges[1::2].tolist())
+        ],
+        doreturn=False,
+    )
+
+
 def raycast(level: Level, x: float, y: float, dir: float):
     # ) -> Optional[tuple[float, int, int]]:
     # Shoot two rays in the same direction. One (vray) is examined at every vertical
@@ -161,60 +310,41 @@ def render_top_view(
 
     screen.fill(0x555555)
 
-    for x in range(level.width):
-        for y in range(level.height):
-            wall_index = level.plane0.get_cell(x, y) * 2 - 2
-            if wall_index <= 256:
-                surf = media.get_wall_surface(wall_index)
-                if surf:
-                    if grid_size != 64:
-                        surf = pygame.transform.scale(surf, (grid_size, grid_size))
-                    screen.blit(
-                        surf,
-                        (x * grid_size + offs_x, y * grid_size + offs_y),
-                    )
+    for y, x in zip(*np.nonzero(level.tile_kind == TILE_SOLID)):
+        wall_index = level.plane0.get_cell(x, y) * 2 - 2
+        surf = media.get_wall_surface(wall_index)
+        if surf:
+            if grid_size != 64:
+                surf = pygame.transform.scale(surf, (grid_size, grid_size))
+            screen.blit(
+                surf,
+                (x * grid_size + offs_x, y * grid_size + offs_y),
+            )
 
-    all_objects = [obj for obj in state.static_objects]
-    all_objects.extend([c for c in state.collectibles if not c.collected])
+    xs, ys, sprites, active = state.get_sprites()
+    objects = np.flatnonzero(active)
+    xs = (xs[objects] * grid_size + offs_x).astype(int) - grid_size // 2
+    ys = (ys[objects] * grid_size + offs_y).astype(int) - grid_size // 2
 
-    for a in all_objects:
-        try:
-            sprite = state.assets.media.sprites[a.sprite]
-        except KeyError:
+    for sprite, x, y in zip(sprites[objects].tolist(), xs.tolist(), ys.tolist()):
+        surf = media.get_scaled_sprite_surface(sprite, grid_size)
+        if not surf:
             print("Sprite not found!")
             continue
-        if sprite:
-            sprite.render(
-                screen,
-                int(a.x * grid_size + offs_x) - grid_size // 2,
-                int(a.y * grid_size + offs_y) - grid_size // 2,
-                grid_size,
-                grid_size,
-            )
+        screen.blit(surf, (x, y))
 
+    fov = pi * 0.125
     raycaster = Raycaster()
+    hits = raycaster.cast_frame(
+        state, level, state.player_x, state.player_y, state.player_dir, fov, 20
+    )
+    x, y = state.player_x * grid_size, state.player_y * grid_size
 
-    fov = pi * 0.125
-    dir = state.player_dir - fov
-    while dir <= state.player_dir + fov:
-        hit = raycaster.raycast(state, level, state.player_x, state.player_y, dir)
-        if hit:
-            distance, tx, _, xy, tile = hit
-            x, y = state.player_x * grid_size, state.player_y * grid_size
-            dx, dy = rotate(grid_size, 0, dir)
-            pygame.draw.line(
-                screen,
-                "green",
-                (x + offs_x, y + offs_y),
-                (x + dx * distance + offs_x, y + dy * distance + offs_y),
-            )
-            pygame.draw.circle(
-                screen,
-                "orange",
-                (xy[0] * grid_size + offs_x, xy[1] * grid_size + offs_y),
-                2,
-            )
-        dir += fov / 10
+    for i in np.flatnonzero(hits.hit):
+        hit_x = hits.hit_x[i] * grid_size + offs_x
+        hit_y = hits.hit_y[i] * grid_size + offs_y
+        pygame.draw.line(screen, "green", (x + offs_x, y + offs_y), (hit_x, hit_y))
+        pygame.draw.circle(screen, "orange", (hit_x, hit_y), 2)
 
     render_player(
         screen,
@@ -224,7 +354,26 @@ def render_top_view(
     )
 
 
-def render_3d(screen: pygame.Surface, state: GameState):
+def render_3d(
+    screen: pygame.Surface,
+    state: GameState,
+    raycaster: Optional[Raycaster] = None,
+    column_step: int = 1,
+    strips: Optional[SurfaceCache] = None,
+    blit_sprites: bool = False,
+):
+    """
+    Render the view of the player. A raycaster can be passed to use another
+    backend for the ray stage, such as ParallelRaycaster for large viewports.
+
+    With a column_step above 1, only every column_step:th column is raycast
+    up front, and columns in the middle of flat walls are interpolated.
+
+    If a strips cache is given, walls are drawn with draw_wall_spans() instead
+    of being sampled pixel by pixel. With blit_sprites, sprites are blitted
+    from the scaled sprite cache of the media, instead of being sampled pixel
+    by pixel.
+    """
     fov = pi * 0.125
 
     level = state.level
@@ -238,102 +387,99 @@ def render_3d(screen: pygame.Surface, state: GameState):
     screen.fill(ceil_color, (0, 0, sw, sh // 2))
     screen.fill(floor_color, (0, sh // 2, sw, sh // 2))
 
-    zbuf = [0.0] * screen.get_width()
-
     # Raycast walls
-    raycaster = Raycaster()
+    raycaster = raycaster or Raycaster()
     w, h = screen.get_width(), screen.get_height()
-    step = (fov * 2) / w
-    for x in range(w):
-        dir = state.player_dir - fov + step * x
-        hit = (
-            raycaster.raycast(state, level, state.player_x, state.player_y, dir) or None
+    hits = _hit_cache.cast_frame(
+        raycaster,
+        state,
+        level,
+        state.player_x,
+        state.player_y,
+        state.player_dir,
+        fov,
+        w,
+        column_step,
+    )
+    pdist = hits.distance / get_ray_table(w, fov).length
+
+    # Note that we use distance instead of wall height
+    # for the Z-buffer, which is used to determine if
+    # each column of the sprites should be rendered or
+    # not. Wolfenstein use wall height, and the reason
+    # could be that the projected distance is not same
+    # as the real distance.
+    zbuf = np.where(hits.hit, np.maximum(pdist, 0), 0.0)
+
+    columns = np.flatnonzero(hits.hit & (pdist > 0))
+    wh = h / pdist[columns] * 0.5
+    top = np.floor(h / 2 - wh).astype(int)
+    bottom = np.floor(h / 2 + wh).astype(int)
+    if strips is not None:
+        draw_wall_spans(
+            screen,
+            state.assets.media,
+            strips,
+            columns.tolist(),
+            top.tolist(),
+            bottom.tolist(),
+            hits.tx[columns].tolist(),
+            hits.texture[columns].tolist(),
         )
-
-        if hit is not None:
-            dist, tx, wall_index, xy, tile = hit
-            pdist = projected_distance(
-                xy[0] - state.player_x,
-                xy[1] - state.player_y,
-                state.player_dir,
-            )
-
-            # Note that we use distance instead of wall height
-            # for the Z-buffer, which is used to determine if
-            # each column of the sprites should be rendered or
-            # not. Wolfenstein use wall height, and the reason
-            # could be that the projected distance is not same
-            # as the real distance.
-            zbuf[x] = max(pdist, 0)
-
-            if pdist > 0:
-                wh = h / (pdist or 1) * 0.5
-                y1 = h / 2 - wh
-                y2 = h / 2 + wh
-
-                draw_column(
-                    screen,
-                    state.assets.media.walls[wall_index],
-                    x,
-                    floor(y1),
-                    floor(y2),
-                    tx,
-                )
-
-    # Render actors
-
-    # TODO: better algo to find visible actors/sprites (4.7.8.1)
-    all_objects = [actor for actor in state.static_objects]
-    all_objects.extend([obj for obj in state.collectibles if not obj.collected])
-    visible_objects = []
-
-    for a in all_objects:
-        rel = Vec2(a.x - state.player_x, a.y - state.player_y)
-        rel = rel.rotate(-state.player_dir)
-        if rel.length == 0:
-            continue
-
-        x_axis = Vec2(1, 0)
-        axis_angle = acos(rel.dot(x_axis) / (rel.length))
-        angle = axis_angle
-        if rel.y < 0:
-            angle = -angle
-
-        # TODO: Try this instead!!
-        angle = atan2(rel.y, rel.x)
-
-        # if angle < fov:
-        center_x = w / 2 + (w / (fov * 2)) * angle
-        # else:
-        # continue
-
-        pdist = projected_distance(
-            a.x - state.player_x, a.y - state.player_y, state.player_dir
+    else:
+        draw_walls(
+            screen,
+            state.assets.media,
+            columns,
+            top,
+            bottom,
+            hits.tx[columns],
+            hits.texture[columns],
         )
 
-        # FIXME: Without this, there's a lot of flickering
-        # from sprites not in front of the player, but directly
-        # to the left/right side of the player. And 0.1 does not
-        # seem to be enough to get rid of *all* the flickering.
-        if pdist < 0.1:
-            continue
-
-        visible_objects.append((a, center_x, pdist))
-
-    visible_objects = reversed(sorted(visible_objects, key=lambda a: a[2]))
-
-    for a, center_x, pdist in visible_objects:
-        sz = h / (pdist or 1)
-        top = h / 2 - sz / 2
-        left = center_x - sz / 2
+    # Render actors
 
+    # Position of every sprite relative to the player, along and across the
+    # view direction
+    xs, ys, sprites, active = state.get_sprites()
+    rel_x, rel_y = xs - state.player_x, ys - state.player_y
+    depth = projected_distance(rel_x, rel_y, state.player_dir)
+    across = rel_y * cos(state.player_dir) - rel_x * sin(state.player_dir)
+
+    # Only objects in tiles that the rays passed through can be visible.
+    # This is described in the Black Book (4.7.8.1)
+    visible = active & hits.visible_tiles[ys.astype(np.intp), xs.astype(np.intp)]
+
+    # FIXME: Without this, there's a lot of flickering
+    # from sprites not in front of the player, but directly
+    # to the left/right side of the player. And 0.1 does not
+    # seem to be enough to get rid of *all* the flickering.
+    visible &= depth >= 0.1
+
+    # Project all visible objects, and draw them from back to front
+    objects = np.flatnonzero(visible)
+    objects = objects[np.argsort(depth[objects], kind="stable")[::-1]]
+    depth, across = depth[objects], across[objects]
+    size = h / depth
+    center_x = w / 2 + (w / 2) * (across / depth) / tan(fov)
+    top = h / 2 - size / 2
+    left = center_x - size / 2
+
+    for i, sprite in enumerate(sprites[objects].tolist()):
+        sz = size[i]
+        if blit_sprites:
+            surf = state.assets.media.get_scaled_sprite_surface(sprite, int(sz))
+            if surf:
+                offset = (int(sz) - surf.get_width()) // 2
+                x, y = int(left[i]) + offset, int(top[i]) + offset
+                draw_sprite(screen, surf, x, y, depth[i], zbuf)
+                continue
         try:
-            sprite = state.assets.media.sprites[a.sprite]
-            sprite.render_with_zbuf(
-                screen, int(left), int(top), int(sz), int(sz), pdist, zbuf
+            state.assets.media.sprites[sprite].render_with_zbuf(
+                screen, int(left[i]), int(top[i]), int(sz), int(sz), depth[i], zbuf
             )
         except KeyError:
-            print(f"Sprite not found: {a.sprite}")
+            print(f"Sprite not found: {sprite}")
 
 
 def run_wall_display(assets: GameAssets):
@@ -385,10 +531,9 @@ def run_sprite_display(assets: GameAssets):
     def render_sprite(index):
         screen.fill("black")
 
-        sprite = assets.media.get_sprite_surface(index)
+        sprite = assets.media.get_scaled_sprite_surface(index, 512)
         if sprite:
-            scaled = pygame.transform.scale(sprite, (512, 512))
-            screen.blit(scaled, (margin, margin, w, h))
+            screen.blit(sprite, (margin, margin, w, h))
 
         pygame.display.flip()
 
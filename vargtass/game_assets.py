@@ -1,12 +1,18 @@
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import astuple, dataclass
 from enum import Enum, IntEnum
 import logging
+import mmap
 import os
 import time
-from typing import List, Optional, Tuple
+from typing import Callable, Collection, Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
 import pygame
 
+from .asset_cache import AssetCache, hash_files
+from .chunk_cache import ChunkCache
+from .surface_cache import SurfaceCache, quantize_size
 from .utils import chunks, print_header, print_hex
 
 
@@ -59,68 +65,118 @@ def to_u32(data: bytes, offset: int = 0):
 
 
 def decompress_rlew(data: bytes, rlew_tag: int):
-    de = bytearray()
-    idx = 0
+    return bytearray(_expand_rlew(data, rlew_tag).tobytes())
+
+
+def _expand_rlew(data: bytes, rlew_tag: int, out: Optional[np.ndarray] = None):
+    """
+    Expand RLEW compressed data into an array of 16-bit words. The array is
+    allocated from the size stored in the data, unless one is given.
+    """
+    words = np.frombuffer(data, dtype="<u2", count=len(data) // 2)
+    size = int(words[0])
+    if out is None:
+        out = np.empty(size // 2, dtype=np.uint16)
+    elif out.size * 2 != size:
+        raise Exception(
+            f"Decompressed size mismatch: expected {size}, got {out.size * 2}"
+        )
 
-    def pop():
-        nonlocal idx
-        idx += 2
-        return data[idx - 2] + (data[idx - 1] << 8)
+    # Every word is copied once, except for the tags, which are followed by
+    # the length and value of a run. A tag can also appear as the length or
+    # value of a run, so tags inside the previous run are skipped.
+    runs = []
+    src = 1
+    for tag in np.flatnonzero(words == rlew_tag).tolist():
+        if tag >= src:
+            runs.append(tag)
+            src = tag + 3
+    runs = np.array(runs, dtype=np.intp)
 
-    size = pop()
+    counts = np.ones(len(words), dtype=np.intp)
+    counts[0] = 0
+    counts[runs] = 0
+    counts[runs + 1] = 0
+    counts[runs + 2] = words[runs + 1]
 
-    while idx < len(data):
-        v = pop()
-        if v == rlew_tag:
-            n, r = pop(), pop()
-            for _ in range(n):
-                de.append(r & 0xFF)
-                de.append(r >> 8)
-        else:
-            de.append(v & 0xFF)
-            de.append(v >> 8)
+    total = int(counts.sum())
+    if total != out.size:
+        raise Exception(f"Decompressed size mismatch: expected {size}, got {total * 2}")
+    out[:] = np.repeat(words, counts)
 
-    if len(de) != size:
-        raise Exception(f"Decompressed size mismatch: expected {size}, got {len(de)}")
+    return out
 
-    return de
 
+NEAR_POINTER = 0xA7
+FAR_POINTER = 0xA8
 
-def decompress_carmack(data: bytes):
-    NEAR_POINTER = 0xA7
-    FAR_POINTER = 0xA8
-
-    def pop():
-        nonlocal idx
-        idx += 1
-        return data[idx - 1]
-
-    de = bytearray()
-    idx = 0
-    size = pop() + (pop() << 8)
 
+def decompress_carmack(data: bytes):
+    size = to_u16(data)
+    de = bytearray(size)
+
+    # Offset of the next pointer from every offset in the data, when reading
+    # words from there on. Pointers are tagged in their high byte, and only
+    # count if they start at the same word alignment. Offsets that have no
+    # pointer after them map to the last whole word of the data.
+    high = np.frombuffer(data, dtype=np.uint8)
+    tagged = np.flatnonzero((high == NEAR_POINTER) | (high == FAR_POINTER)) - 1
+    next_pointer = np.full(len(data) + 1, len(data) + 2)
+    next_pointer[tagged[tagged >= 0]] = tagged[tagged >= 0]
+    for i in range(2):
+        following = np.minimum.accumulate(next_pointer[i::2][::-1])[::-1]
+        next_pointer[i::2] = np.minimum(following, len(data) - (len(data) - i) % 2)
+    next_pointer = next_pointer.tolist()
+
+    idx, dst = 2, 0
     while idx < len(data):
-        n, kw = pop(), pop()
-        if kw in (NEAR_POINTER, FAR_POINTER):
-            if n == 0:
-                de.append(pop())
-                de.append(kw)
-            else:
-                if kw == NEAR_POINTER:
-                    offs = len(de) - pop() * 2
-                else:
-                    offs = (pop() + (pop() << 8)) * 2
-                de.extend(de[offs : offs + n * 2])
+        # Copy the words up to the next pointer as they are
+        end = next_pointer[idx]
+        if end != idx:
+            de[dst : dst + end - idx] = data[idx:end]
+            dst += end - idx
+            if end >= len(data) - 1:
+                break
+
+        n, kw = data[end], data[end + 1]
+        if n == 0:
+            # Escaped word, whose high byte is a pointer tag
+            de[dst] = data[end + 2]
+            de[dst + 1] = kw
+            dst += 2
+            idx = end + 3
+            continue
+
+        if kw == NEAR_POINTER:
+            offs = dst - data[end + 2] * 2
+            idx = end + 3
         else:
-            de.append(n)
-            de.append(kw)
+            offs = (data[end + 2] | data[end + 3] << 8) * 2
+            idx = end + 4
+        if not 0 <= offs < dst:
+            raise Exception(f"Invalid back-reference to {offs} at {dst}")
+
+        # A reference that overlaps the output repeats the words from offs
+        n *= 2
+        while n > 0:
+            k = min(n, dst - offs)
+            de[dst : dst + k] = de[offs : offs + k]
+            dst, n = dst + k, n - k
 
-    if len(de) != size:
-        raise Exception(f"Decompressed size mismatch: expected {size}, got {len(de)}")
+    if len(de) != size or dst != size:
+        raise Exception(f"Decompressed size mismatch: expected {size}, got {dst}")
 
     return de
 
 
+def decompress_plane(data: bytes, rlew_tag: int, out: Optional[np.ndarray] = None):
+    """
+    Decompress a map plane, stored with Carmack and RLEW compression, into an
+    array of 16-bit words. The words are written to out if it is given.
+    """
+    return _expand_rlew(decompress_carmack(data), rlew_tag, out)
+
+
 DOOR_HORIZONTAL = 0
 DOOR_VERTICAL = 1
 
@@ -128,15 +184,23 @@ DOOR_VERTICAL = 1
 class Plane:
     width: int
     height: int
-    map: list[int]
+
+    # Little-endian 16-bit cells, in row major order. This is a view of the
+    # decompressed data, which is not copied.
+    map: np.ndarray
 
     def __init__(self, map: bytes, width: int, height: int):
-        assert len(map) == width * height * 2
         self.width, self.height = width, height
-        self.map = [to_u16(map, i) for i in range(0, len(map), 2)]
+        self.map = np.frombuffer(map, dtype="<u2")
+        assert self.map.size == width * height
+
+    # All cells, indexed by [y, x]
+    @property
+    def cells(self):
+        return self.map.reshape(self.height, self.width)
 
     def get_cell(self, x: int, y: int):
-        return self.map[y * self.width + x]
+        return int(self.map[y * self.width + x])
 
     def get_door_orientation(self, x: int, y: int):
         n = self.get_cell(x, y)
@@ -243,52 +307,87 @@ class LevelHeader:
     name: str
 
 
+# Tile kinds, as stored in Level.tile_kind
+TILE_EMPTY = 0
+TILE_SOLID = 1
+TILE_DOOR = 2
+
+# Plane 0 codes of floor tiles. Each code from AREA_TILE up marks an area of
+# the level, while ambush tiles belong to the area of a neighbouring tile.
+AMBUSH_TILE = 106
+AREA_TILE = 107
+LAST_AREA_TILE = 143
+
+# Textures of doors, as seen across a horizontal or a vertical tile edge
+DOOR_TEXTURE_HORIZONTAL = 98
+DOOR_TEXTURE_VERTICAL = 99
+
+# Faces of a tile, as indexed in the last axis of Level.tile_textures
+FACE_NORTH = 0
+FACE_EAST = 1
+FACE_SOUTH = 2
+FACE_WEST = 3
+
+
 class Tile:
+    """
+    Light-weight view of a single tile in a level. The tile data itself
+    is stored in the flat arrays of the level.
+    """
+
+    __slots__ = ("level", "x", "y")
+
+    level: "Level"
+    x: int
+    y: int
+
+    def __init__(self, level: "Level", x: int, y: int):
+        self.level, self.x, self.y = level, x, y
+
     # True if this tile is a wall tile. Note that doors are not solid.
-    is_solid: bool
+    @property
+    def is_solid(self):
+        return self.level.tile_kind[self.y, self.x] == TILE_SOLID
 
     # True if this tile is a door
-    is_door: bool
+    @property
+    def is_door(self):
+        return self.level.tile_kind[self.y, self.x] == TILE_DOOR
 
-    # Door id for lookup tables
-    door_id: int
+    # Door id for lookup tables, or -1 if this is not a door
+    @property
+    def door_id(self):
+        return int(self.level.door_ids[self.y, self.x])
 
     # Plane 0, 1, 2 value for this tile
-    p0: int
-    p1: int
-    p2: int
+    @property
+    def p0(self):
+        return self.level.plane0.get_cell(self.x, self.y)
+
+    @property
+    def p1(self):
+        return self.level.plane1.get_cell(self.x, self.y)
 
-    # True if there is an adjacent door (north, east, south, west)
-    adj_door: List[bool]
+    @property
+    def p2(self):
+        return self.level.plane2.get_cell(self.x, self.y)
 
     # Texture index (north, east, south, west)
-    texture: List[int]
-
-    def __init__(self, p0: int, p1: int, p2: int):
-        self.p0, self.p1, self.p2 = p0, p1, p2
-        self.is_solid = p0 < 64
-        self.is_door = (p0 >= 90 and p0 <= 95) or p0 == 100 or p0 == 101
-        self.adj_door = [False, False, False, False]
-
-    def freeze(self):
-        self.textures = [
-            101 if self.adj_door[0] else self.p0 * 2 - 1,
-            100 if self.adj_door[1] else self.p0 * 2 - 2,
-            101 if self.adj_door[2] else self.p0 * 2 - 1,
-            100 if self.adj_door[3] else self.p0 * 2 - 2,
-        ]
+    @property
+    def textures(self):
+        return [int(t) for t in self.level.tile_textures[self.y, self.x]]
 
     def get_texture_north(self):
-        return self.textures[0]
+        return int(self.level.tile_textures[self.y, self.x, FACE_NORTH])
 
     def get_texture_south(self):
-        return self.textures[2]
+        return int(self.level.tile_textures[self.y, self.x, FACE_SOUTH])
 
     def get_texture_east(self):
-        return self.textures[1]
+        return int(self.level.tile_textures[self.y, self.x, FACE_EAST])
 
     def get_texture_west(self):
-        return self.textures[3]
+        return int(self.level.tile_textures[self.y, self.x, FACE_WEST])
 
 
 class Level:
@@ -296,7 +395,38 @@ class Level:
     plane0: Plane0
     plane1: Plane1
     plane2: Plane2
-    tiles: List[List[Tile]]
+
+    # Kind of each tile (TILE_EMPTY, TILE_SOLID or TILE_DOOR), indexed by [y, x]
+    tile_kind: np.ndarray
+
+    # Texture index of each face (north, east, south, west), indexed by [y, x, face]
+    tile_textures: np.ndarray
+
+    # Door id of each tile, or -1 for tiles that are not doors. Indexed by [y, x]
+    door_ids: np.ndarray
+
+    # Total number of doors in the level
+    door_count: int
+
+    # Position of each door as [y, x], indexed by door id
+    door_tiles: np.ndarray
+
+    # Area number of each floor tile, or -1 for other tiles. Indexed by [y, x]
+    areas: np.ndarray
+
+    # Total number of areas in the level
+    area_count: int
+
+    # Areas on either side of each door, or -1 if there is no floor tile on a
+    # side. Indexed by [door id, side]
+    door_areas: np.ndarray
+
+    # Chebyshev distance from each tile to the nearest wall or door, where
+    # everything outside of the level counts as walls. Indexed by [y, x]
+    blocker_distance: np.ndarray
+
+    # Incremented every time the tiles change
+    revision: int = 0
 
     def __init__(
         self,
@@ -311,38 +441,151 @@ class Level:
         self.plane2 = plane2
         self._preprocess()
 
+    # Arrays derived from the planes when the level is loaded
+    derived_arrays = (
+        "tile_kind",
+        "tile_textures",
+        "door_ids",
+        "blocker_distance",
+        "areas",
+        "door_areas",
+    )
+
+    def get_arrays(self):
+        """
+        Returns the header, planes and derived arrays of the level, from
+        which it can be restored with from_arrays()
+        """
+        arrays = {
+            "header": np.array(astuple(self.header)[:-1]),
+            "name": np.array(self.header.name),
+            "plane0": self.plane0.map,
+            "plane1": self.plane1.map,
+            "plane2": self.plane2.map,
+        }
+        for name in self.derived_arrays:
+            arrays[name] = getattr(self, name)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]):
+        """
+        Restore a level from the arrays returned by get_arrays(), without
+        preprocessing the planes again. The derived arrays are copied, since
+        the level can change while it's played.
+        """
+        header = LevelHeader(*arrays["header"].tolist(), name=str(arrays["name"]))
+        w, h = header.width, header.height
+
+        level = cls.__new__(cls)
+        level.header = header
+        level.plane0 = Plane0(arrays["plane0"], w, h)
+        level.plane1 = Plane1(arrays["plane1"], w, h)
+        level.plane2 = Plane2(arrays["plane2"], w, h)
+        for name in cls.derived_arrays:
+            setattr(level, name, np.array(arrays[name]))
+
+        level.door_tiles = np.argwhere(level.door_ids >= 0)
+        level.door_count = len(level.door_tiles)
+        level.area_count = int(level.areas.max()) + 1
+        return level
+
     def _preprocess(self):
-        self.tiles = [
-            [
-                Tile(
-                    p0=self.plane0.get_cell(x, y),
-                    p1=self.plane1.get_cell(x, y),
-                    p2=self.plane2.get_cell(x, y),
-                )
-                for x in range(self.width)
-            ]
-            for y in range(self.height)
-        ]
+        p0 = self.plane0.cells.astype(np.int32)
+
+        door = ((p0 >= 90) & (p0 <= 95)) | (p0 == 100) | (p0 == 101)
+        self.tile_kind = np.where(p0 < 64, TILE_SOLID, TILE_EMPTY).astype(np.uint8)
+        self.tile_kind[door] = TILE_DOOR
+
+        # Door ids are given in row major order, which is also the order of
+        # the tiles returned by argwhere
+        ids = np.cumsum(door.ravel()).reshape(door.shape) - 1
+        self.door_ids = np.where(door, ids, -1).astype(np.int16)
+        self.door_count = int(door.sum())
+        self.door_tiles = np.argwhere(door)
+
+        # True if there is an adjacent door (north, east, south, west)
+        adj_door = np.zeros(door.shape + (4,), dtype=bool)
+        adj_door[1:, :, FACE_NORTH] = door[:-1, :]
+        adj_door[:, :-1, FACE_EAST] = door[:, 1:]
+        adj_door[:-1, :, FACE_SOUTH] = door[1:, :]
+        adj_door[:, 1:, FACE_WEST] = door[:, :-1]
+
+        # Sides facing a door show the door frame, others the wall texture
+        walls = np.stack((p0 * 2 - 1, p0 * 2 - 2, p0 * 2 - 1, p0 * 2 - 2), axis=-1)
+        frames = np.array([101, 100, 101, 100])
+        self.tile_textures = np.where(adj_door, frames, walls).astype(np.int16)
+
+        self.blocker_distance = self._compute_blocker_distance()
+        self._label_areas()
+
+    def _label_areas(self):
+        codes = self.plane0.cells
+        floor = (codes >= AREA_TILE) & (codes <= LAST_AREA_TILE)
+        self.areas = np.where(floor, codes - AREA_TILE, -1).astype(np.int16)
+        self.area_count = int(self.areas.max()) + 1
+
+        # Ambush tiles take the area of the first neighbouring floor tile to
+        # the east, west, north or south
+        ambush = codes == AMBUSH_TILE
+        for dy, dx in ((0, 1), (0, -1), (-1, 0), (1, 0)):
+            neighbour = self._shifted(self.areas, dx, dy)
+            fill = ambush & (self.areas < 0) & (neighbour >= 0)
+            self.areas[fill] = neighbour[fill]
+
+        # A door joins the areas to its west and east if both are floor, and
+        # the areas to its north and south otherwise
+        ys, xs = self.door_tiles.T
+        padded = np.pad(self.areas, 1, constant_values=-1)
+        west, east = padded[ys + 1, xs], padded[ys + 1, xs + 2]
+        north, south = padded[ys, xs + 1], padded[ys + 2, xs + 1]
+        across = ((west >= 0) & (east >= 0))[:, None]
+        self.door_areas = np.where(
+            across, np.stack((west, east), 1), np.stack((north, south), 1)
+        )
 
-        door_index = 0
-
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.tiles[y][x].is_door:
-                    self.tiles[y][x].door_id = door_index
-                    door_index += 1
-                    if y < self.height - 1:
-                        self.tiles[y + 1][x].adj_door[0] = True
-                    if x > 0:
-                        self.tiles[y][x - 1].adj_door[1] = True
-                    if y > 0:
-                        self.tiles[y - 1][x].adj_door[2] = True
-                    if x < self.width - 1:
-                        self.tiles[y][x + 1].adj_door[3] = True
-
-        for y in range(self.height):
-            for x in range(self.width):
-                self.tiles[y][x].freeze()
+    @staticmethod
+    def _shifted(a: np.ndarray, dx: int, dy: int):
+        """The value of the tile at (x + dx, y + dy) for each tile, or -1"""
+        padded = np.pad(a, 1, constant_values=-1)
+        h, w = a.shape
+        return padded[1 + dy : 1 + dy + h, 1 + dx : 1 + dx + w]
+
+    def _compute_blocker_distance(self):
+        # Grow the set of blockers one tile at a time in all eight directions
+        reached = np.ones((self.height + 2, self.width + 2), dtype=bool)
+        reached[1:-1, 1:-1] = self.tile_kind != TILE_EMPTY
+        distance = np.zeros(reached.shape, dtype=np.int16)
+
+        k = 0
+        while not reached.all():
+            k += 1
+            grown = reached.copy()
+            grown[1:, :] |= reached[:-1, :]
+            grown[:-1, :] |= reached[1:, :]
+            grown[:, 1:] |= grown[:, :-1].copy()
+            grown[:, :-1] |= grown[:, 1:].copy()
+            distance[grown & ~reached] = k
+            reached = grown
+
+        return distance[1:-1, 1:-1]
+
+    def set_tile_kind(self, x: int, y: int, kind: int):
+        """
+        Change the kind of a tile, for example when a pushwall has moved, and
+        update the blocker distance field.
+        """
+        prev = self.tile_kind[y, x]
+        self.tile_kind[y, x] = kind
+        self.revision += 1
+
+        if prev == TILE_EMPTY and kind != TILE_EMPTY:
+            # A new blocker can only bring others closer
+            ys, xs = np.ogrid[0 : self.height, 0 : self.width]
+            dist = np.maximum(np.abs(ys - y), np.abs(xs - x))
+            self.blocker_distance[:] = np.minimum(self.blocker_distance, dist)
+        elif prev != TILE_EMPTY and kind == TILE_EMPTY:
+            self.blocker_distance = self._compute_blocker_distance()
 
     @property
     def width(self):
@@ -352,28 +595,34 @@ class Level:
     def height(self):
         return self.header.height
 
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    def get_area(self, x: int, y: int):
+        """Area number of a floor tile, or -1 for walls and doors"""
+        return int(self.areas[y, x])
+
+    def get_tile(self, x: int, y: int):
+        return Tile(self, x, y)
+
     def is_solid(self, x, y):
-        return self.tiles[y][x].is_solid
+        return self.tile_kind[y, x] == TILE_SOLID
 
     def is_door(self, x, y):
-        return self.tiles[y][x].is_door
+        return self.tile_kind[y, x] == TILE_DOOR
 
     def get_wall(self, x, y):
         return self.plane0.get_cell(x, y)
 
     # Returns position and direction of the player spawn point
     def get_player_spawn(self):
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.plane1.get_cell(x, y) == 19:
-                    return (x, y), 0
-                if self.plane1.get_cell(x, y) == 20:
-                    return (x, y), 90
-                if self.plane1.get_cell(x, y) == 21:
-                    return (x, y), 180
-                if self.plane1.get_cell(x, y) == 22:
-                    return (x, y), 270
-        raise Exception("No player spawn point found in map")
+        codes = self.plane1.map
+        spawns = np.flatnonzero((codes >= 19) & (codes <= 22))
+        if len(spawns) == 0:
+            raise Exception("No player spawn point found in map")
+        y, x = divmod(int(spawns[0]), self.width)
+        return (x, y), (int(codes[spawns[0]]) - 19) * 90
 
 
 class Sprite:
@@ -385,9 +634,10 @@ class Sprite:
     pixel_pool: List[int]
     column_posts: List[List[Tuple[int, int]]]
 
-    # Non-optimized columns with one value for every pixel,
-    # and None for transparent pixels
-    column_pixels: List[int]
+    # All pixels of the sprite, indexed by [x, y], and the mask of
+    # the pixels that are not transparent
+    pixels: np.ndarray
+    mask: np.ndarray
 
     def __init__(self, width: int, height: int):
         self.width, self.height = width, height
@@ -409,6 +659,7 @@ class Sprite:
         pool_offset = 4 + (spr.last_col - spr.first_col + 1) * 2
         spr.pixel_pool_raw = data[pool_offset:]
         spr.pixel_pool = [palette[idx] for idx in spr.pixel_pool_raw]
+        pool = np.array(spr.pixel_pool, dtype=np.uint32)
 
         for post_offset in col_offsets:
             n = 0
@@ -423,19 +674,27 @@ class Sprite:
                 n += 6
             spr.column_posts.append(posts)
 
-        spr._generate_column_pixels()
+        spr.pixels = np.zeros((spr.width, spr.height), dtype=np.uint32)
+        spr.mask = np.zeros((spr.width, spr.height), dtype=bool)
+        pix = 0
+        for x, posts in enumerate(spr.column_posts, spr.first_col):
+            for first_row, last_row in posts:
+                n = last_row - first_row
+                spr.pixels[x, first_row:last_row] = pool[pix : pix + n]
+                spr.mask[x, first_row:last_row] = True
+                pix += n
+
         return spr
 
-    def _generate_column_pixels(self):
-        self.column_pixels: List[List[Optional[int]]] = []
-        pix = 0
-        for col in self.column_posts:
-            pixels: List[Optional[int]] = [None] * self.height
-            for first_row, last_row in col:
-                for y in range(first_row, last_row):
-                    pixels[y] = self.pixel_pool[pix]
-                    pix += 1
-            self.column_pixels.append(pixels)
+    @classmethod
+    def from_arrays(
+        cls, pixels: np.ndarray, mask: np.ndarray, first_col: int, last_col: int
+    ):
+        """Sprite from pixels that have already been decoded"""
+        spr = Sprite(pixels.shape[0], pixels.shape[1])
+        spr.first_col, spr.last_col = first_col, last_col
+        spr.pixels, spr.mask = pixels, mask
+        return spr
 
     def to_surface_optimized(self):
         surf = pygame.Surface((64, 64))
@@ -450,14 +709,21 @@ class Sprite:
         return surf
 
     def to_surface(self):
-        surf = pygame.Surface((64, 64))
-        pxarray = pygame.PixelArray(surf)
-        pix = 0
-        for x, pixels in enumerate(self.column_pixels):
-            for y, pix in enumerate(pixels):
-                v = 0xFF00FF if pix is None else pix
-                pxarray[self.first_col + x, y] = v  # type: ignore
-        pxarray.close()
+        # Transparent pixels are magenta, except in columns that are empty
+        pixels = np.where(self.mask, self.pixels, 0xFF00FF)
+        pixels[: self.first_col] = 0
+        pixels[self.last_col + 1 :] = 0
+
+        surf = pygame.Surface((self.width, self.height))
+        pygame.surfarray.blit_array(surf, pixels)
+        return surf
+
+    def to_keyed_surface(self):
+        """Returns the sprite as a surface with transparent pixels colour keyed"""
+        key = 0xFF00FF
+        surf = pygame.Surface((self.width, self.height))
+        pygame.surfarray.blit_array(surf, np.where(self.mask, self.pixels, key))
+        surf.set_colorkey(key)
         return surf
 
     def render_optimized(self, screen: pygame.Surface, x: int, y: int, w: int, h: int):
@@ -482,31 +748,7 @@ class Sprite:
                         screen.set_at((int(screen_col + x), int(screen_y)), color)
 
     def render(self, screen: pygame.Surface, x: int, y: int, w: int, h: int):
-        if y + h < 0 or y >= screen.get_height():
-            return
-        if x + w < 0 or x >= screen.get_width():
-            return
-
-        step_x = self.width / w
-        step_y = self.height / h
-        scr_x = max(x, 0)
-
-        while scr_x - x < w and scr_x < screen.get_width():
-            column = int((scr_x - x) * step_x) - self.first_col
-            if column < 0 or column >= len(self.column_pixels):
-                scr_x += 1
-                continue
-
-            scr_y = max(y, 0)
-
-            while scr_y - y < h and scr_y < screen.get_height():
-                row = int((scr_y - y) * step_y)
-                color = self.column_pixels[column][row]
-                if color is not None:
-                    screen.set_at((scr_x, scr_y), color)
-                scr_y += 1
-
-            scr_x += 1
+        self.render_with_zbuf(screen, x, y, w, h, 0, None)
 
     def render_with_zbuf(
         self,
@@ -516,43 +758,94 @@ class Sprite:
         w: int,
         h: int,
         z: float,
-        zbuf: List[float],
+        zbuf: Optional[np.ndarray],
     ):
-        if y + h < 0 or y >= screen.get_height():
-            return
-        if x + w < 0 or x >= screen.get_width():
+        """
+        Draw the sprite scaled to w x h pixels at x, y. Screen columns where
+        the z-buffer has a wall closer than z are skipped.
+        """
+        sw, sh = screen.get_width(), screen.get_height()
+        scr_x = np.arange(max(x, 0), min(x + w, sw))
+        scr_y = np.arange(max(y, 0), min(y + h, sh))
+        if len(scr_x) == 0 or len(scr_y) == 0:
             return
 
-        step_x = self.width / w
-        step_y = self.height / h
-        scr_x = max(x, 0)
+        # Sprite pixel shown in each screen column and row
+        columns = ((scr_x - x) * (self.width / w)).astype(np.intp)
+        rows = ((scr_y - y) * (self.height / h)).astype(np.intp)
 
-        while scr_x - x < w and scr_x < screen.get_width():
-            if zbuf[scr_x] > 0 and zbuf[scr_x] <= z:
-                scr_x += 1
-                continue
+        visible = self.mask[np.ix_(columns, rows)]
+        if zbuf is not None:
+            z_columns = zbuf[scr_x]
+            visible &= ~((z_columns > 0) & (z_columns <= z))[:, None]
 
-            column = int((scr_x - x) * step_x) - self.first_col
-            if column < 0 or column >= len(self.column_pixels):
-                scr_x += 1
-                continue
+        i, j = np.nonzero(visible)
+        pixels = pygame.surfarray.pixels2d(screen)
+        pixels[scr_x[i], scr_y[j]] = self.pixels[columns[i], rows[j]]
+        del pixels
 
-            scr_y = max(y, 0)
 
-            while scr_y - y < h and scr_y < screen.get_height():
-                row = int((scr_y - y) * step_y)
-                color = self.column_pixels[column][row]
-                if color is not None:
-                    screen.set_at((scr_x, scr_y), color)
-                scr_y += 1
+class VswapFile:
+    """
+    Chunks of a VSWAP file: walls, followed by sprites and sounds. The file
+    is memory mapped, and only the tables of chunk offsets and lengths are
+    read up front.
+    """
 
-            scr_x += 1
+    data: mmap.mmap
+    first_sprite: int
+    first_sound: int
+    offsets: List[int]
+    lengths: List[int]
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Total chunk count, first chunk that is a sprite and first chunk
+        # that is a sound
+        tot = to_u16(self.data, 0)
+        self.first_sprite = to_u16(self.data, 2)
+        self.first_sound = to_u16(self.data, 4)
+
+        # Chunk offsets and lengths
+        self.offsets = [to_u32(self.data, 6 + i * 4) for i in range(tot)]
+        self.lengths = [to_u16(self.data, 6 + tot * 4 + i * 2) for i in range(tot)]
+
+    def get_chunk(self, index: int):
+        offset = self.offsets[index]
+        return self.data[offset : offset + self.lengths[index]]
+
+    def get_wall_indices(self):
+        return [i for i in range(self.first_sprite) if self.lengths[i] > 0]
+
+    def get_sprite_indices(self):
+        return [
+            i - self.first_sprite
+            for i in range(self.first_sprite, self.first_sound)
+            if self.lengths[i] > 0
+        ]
 
 
 class Media:
-    walls: dict[int, list[int]]
-    wall_surfaces: dict[int, pygame.Surface]
-    sprites: dict[int, Sprite]
+    # Pixels of all walls, indexed by [wall, x, y]. Every column of a wall is
+    # contiguous, which is the order walls are drawn and stored in VSWAP.
+    # Walls are only written when they are decoded, so the pages of walls
+    # that are never used are not backed by memory.
+    wall_atlas: np.ndarray
+
+    # Flat views of the walls in the atlas, indexed by [x * 64 + y]. Walls
+    # and sprites are decoded from the VSWAP file on first access.
+    walls: ChunkCache[np.ndarray]
+    wall_surfaces: ChunkCache[pygame.Surface]
+    sprites: ChunkCache[Sprite]
+
+    # Colour keyed surfaces of the sprites, and versions of them scaled to
+    # quantized sizes
+    sprite_surfaces: ChunkCache[pygame.Surface]
+    scaled_sprites: SurfaceCache
+
+    vswap: Optional[VswapFile]
     sounds: dict[int, int]
 
     # fmt: off
@@ -592,42 +885,153 @@ class Media:
     ]
     # fmt: on
 
-    def __init__(self):
-        self.walls = {}
-        self.wall_surfaces = {}
-        self.sprites = {}
+    palette_array = np.array(palette, dtype=np.uint32)
+
+    def __init__(
+        self,
+        wall_count: int = 0,
+        vswap: Optional[VswapFile] = None,
+        max_sprites: int = 256,
+    ):
+        self.vswap = vswap
+        self.wall_atlas = np.zeros((wall_count, 64, 64), dtype=np.uint32)
+
+        self.max_sprites = max_sprites
+
+        wall_indices, sprite_indices = set(), set()
+        if vswap is not None:
+            wall_indices = set(vswap.get_wall_indices())
+            sprite_indices = set(vswap.get_sprite_indices())
+        self._set_sources(
+            self._decode_wall, wall_indices, self._decode_sprite, sprite_indices
+        )
+
+    def _set_sources(
+        self,
+        decode_wall: Callable[[int], np.ndarray],
+        wall_indices: Collection[int],
+        decode_sprite: Callable[[int], Sprite],
+        sprite_indices: Collection[int],
+    ):
+        self.walls = ChunkCache(decode_wall, wall_indices)
+        self.wall_surfaces = ChunkCache(self._make_wall_surface, self.walls, 64)
+        self.sprites = ChunkCache(decode_sprite, sprite_indices, self.max_sprites)
+        self.sprite_surfaces = ChunkCache(
+            lambda index: self.sprites[index].to_keyed_surface(),
+            self.sprites,
+            self.max_sprites,
+        )
+        self.scaled_sprites = SurfaceCache()
+
+    def get_arrays(self):
+        """
+        Returns all walls and sprites as palette converted arrays, from which
+        the media can be restored with from_arrays(). Every wall and sprite
+        is decoded.
+        """
+        wall_indices = list(self.walls)
+        for index in wall_indices:
+            self.walls[index]
+
+        sprite_indices = list(self.sprites)
+        sprites = [self.sprites[index] for index in sprite_indices]
+        return {
+            "wall_atlas": self.wall_atlas,
+            "wall_indices": np.array(wall_indices, dtype=np.intp),
+            "sprite_indices": np.array(sprite_indices, dtype=np.intp),
+            "sprite_pixels": np.array([spr.pixels for spr in sprites], dtype=np.uint32),
+            "sprite_mask": np.array([spr.mask for spr in sprites], dtype=bool),
+            "sprite_columns": np.array(
+                [(spr.first_col, spr.last_col) for spr in sprites], dtype=np.intp
+            ),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], max_sprites: int = 256):
+        """Restore media from the arrays returned by get_arrays()"""
+        media = cls(0, None, max_sprites)
+        media.wall_atlas = arrays["wall_atlas"]
+        rows = {
+            index: row for row, index in enumerate(arrays["sprite_indices"].tolist())
+        }
+        pixels, mask = arrays["sprite_pixels"], arrays["sprite_mask"]
+        columns = arrays["sprite_columns"].tolist()
+
+        def decode_wall(index: int):
+            return media.wall_atlas[index].reshape(64 * 64)
+
+        def decode_sprite(index: int):
+            row = rows[index]
+            return Sprite.from_arrays(pixels[row], mask[row], *columns[row])
+
+        media._set_sources(
+            decode_wall, set(arrays["wall_indices"].tolist()), decode_sprite, set(rows)
+        )
+        return media
+
+    def _decode_wall(self, index: int):
+        self._write_wall(index, self.vswap.get_chunk(index))
+        return self.wall_atlas[index].reshape(64 * 64)
+
+    def _decode_sprite(self, index: int):
+        data = self.vswap.get_chunk(self.vswap.first_sprite + index)
+        return Sprite.load(data, self.palette)
+
+    def _make_wall_surface(self, index: int):
+        surf = pygame.Surface((64, 64))
+        pygame.surfarray.blit_array(surf, self.walls[index].reshape(64, 64))
+        return surf
+
+    def prefetch(self, walls: Iterable[int], sprites: Iterable[int]):
+        """Decode the given walls and sprites ahead of drawing them"""
+        self.walls.prefetch(walls)
+        self.sprites.prefetch(sprites)
 
     # Adds a wall picture. The data should be the uncompressed image data, palette indexed.
     def add_wall(self, index: int, data: bytes):
         assert len(data) == 64 * 64, "Wall data must be 64x64 pixels"
-        w = [self.palette[i] for i in data]
-        self.walls[index] = w
+        if index >= len(self.wall_atlas):
+            self._grow_wall_atlas(max(index + 1, len(self.wall_atlas) * 2))
+
+        self._write_wall(index, data)
+        self.walls.add(index, self.wall_atlas[index].reshape(64 * 64))
+        self.wall_surfaces.discard(index)
+
+    def _write_wall(self, index: int, data: bytes):
+        pixels = self.palette_array[np.frombuffer(data, dtype=np.uint8)]
+        self.wall_atlas[index] = pixels.reshape(64, 64)
+
+    def _grow_wall_atlas(self, wall_count: int):
+        atlas = np.zeros((wall_count, 64, 64), dtype=np.uint32)
+        atlas[: len(self.wall_atlas)] = self.wall_atlas
+        self.wall_atlas = atlas
+        for walls in (self.walls.pinned, self.walls.decoded):
+            for i in walls:
+                walls[i] = atlas[i].reshape(64 * 64)
 
     def add_sprite(self, index: int, spr: Sprite):
-        self.sprites[index] = spr
+        self.sprites.add(index, spr)
+        self.sprite_surfaces.discard(index)
 
     def get_wall_surface(self, index: int):
-        try:
-            return self.wall_surfaces[index]
-        except KeyError:
-            if index not in self.walls:
-                return None
-            wall = self.walls[index]
-            surf = pygame.Surface((64, 64))
-            pxarray = pygame.PixelArray(surf)
-            wall = self.walls[index]
-            for x in range(64):
-                for y in range(64):
-                    pxarray[y, x] = wall[y * 64 + x]  # type: ignore
-            pxarray.close()
-            self.wall_surfaces[index] = surf
-            return surf
+        return self.wall_surfaces.get(index)
 
     def get_sprite_surface(self, index: int):
-        try:
-            return self.sprites[index].to_surface()
-        except KeyError:
+        return self.sprite_surfaces.get(index)
+
+    def get_scaled_sprite_surface(self, index: int, size: int):
+        """
+        Returns the sprite scaled to about size x size pixels. The size is
+        quantized, so that the scaled surfaces can be cached and shared
+        between sprites of almost the same size.
+        """
+        base = self.get_sprite_surface(index)
+        if base is None:
             return None
+        size = quantize_size(size)
+        return self.scaled_sprites.get(
+            (index, size), lambda: pygame.transform.scale(base, (size, size))
+        )
 
 
 class GameAssets:
@@ -636,51 +1040,60 @@ class GameAssets:
     level_headers: list[LevelHeader]
     media: Media
 
+    # Cache of decoded arrays on disk, if any
+    cache: Optional[AssetCache] = None
+
+    # Arrays of the most recently loaded levels, by level number
+    recent_levels: "OrderedDict[int, Dict[str, np.ndarray]]"
+    max_recent_levels: int = 8
+
+    def __init__(self):
+        self.recent_levels = OrderedDict()
+
     def load_maphead(self, path: str):
         # TODO: the file format supports optional tile data after the level offsets.
         # This is however not used in Wolfenstein 3D, so it's not implemented here.
         data = open(path, "rb").read()
+        self.maphead = data
         self.rlew_tag = data[0] | (data[1] << 8)
         self.level_offsets = [to_u32(b) for b in chunks(data[2:], 4)]
 
     def load_gamemaps(self, path: str):
-        data = open(path, "rb").read()
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         if data[0:8] != b"TED5v1.0":
             raise Exception("Invalid GAMEMAPS header: missing TED5v1.0 signature")
         self.gamemaps = data
 
     def load_vswap(self, path: str):
-        data = open(path, "rb").read()
-
-        # Total chunk count
-        tot = to_u16(data, 0)
-
-        # First chunk that is a sprite
-        first_sprite = to_u16(data, 2)
-
-        # First chunk that is a sound
-        first_sound = to_u16(data, 4)
+        # Walls and sprites are decoded when they are first used
+        vswap = VswapFile(path)
+        self.media = Media(vswap.first_sprite, vswap)
 
-        # Chunk offsets and lengths
-        offsets = [to_u32(data, 6 + i * 4) for i in range(tot)]
-        lengths = [to_u16(data, 6 + tot * 4 + i * 2) for i in range(tot)]
-
-        self.media = Media()
-
-        for i in range(first_sprite):
-            if lengths[i] > 0:
-                self.media.add_wall(i, data[offsets[i] : offsets[i] + lengths[i]])
-
-        for i in range(first_sprite, first_sound):
-            if lengths[i] > 0:
-                self.media.add_sprite(
-                    i - first_sprite,
-                    Sprite.load(
-                        data[offsets[i] : offsets[i] + lengths[i]], self.media.palette
-                    ),
-                )
+    def has_level(self, level: int):
+        return 0 <= level < len(self.level_offsets) and self.level_offsets[level] > 0
 
     def load_level(self, level: int):
+        """
+        Returns a new instance of a level. Recently loaded levels are restored
+        from memory and others from the cache on disk, if there is one, and
+        only decoded if they are in neither.
+        """
+        arrays = self.recent_levels.pop(level, None)
+        if arrays is None and self.cache is not None:
+            arrays = self.cache.load(f"level{level:03d}")
+        if arrays is None:
+            arrays = self.decode_level(level).get_arrays()
+            if self.cache is not None:
+                self.cache.save(f"level{level:03d}", arrays)
+
+        self.recent_levels[level] = arrays
+        while len(self.recent_levels) > self.max_recent_levels:
+            self.recent_levels.popitem(last=False)
+
+        return Level.from_arrays(arrays)
+
+    def decode_level(self, level: int):
         o = self.level_offsets[level]
         hdr = LevelHeader(
             plane0_offset=to_u32(self.gamemaps, o + 0),
@@ -695,19 +1108,13 @@ class GameAssets:
         )
 
         map = self.gamemaps[hdr.plane0_offset : hdr.plane0_offset + hdr.plane0_len]
-        map = decompress_carmack(map)
-        map = decompress_rlew(map, self.rlew_tag)
-        plane0 = Plane0(map, hdr.width, hdr.height)
+        plane0 = Plane0(decompress_plane(map, self.rlew_tag), hdr.width, hdr.height)
 
         map = self.gamemaps[hdr.plane1_offset : hdr.plane1_offset + hdr.plane1_len]
-        map = decompress_carmack(map)
-        map = decompress_rlew(map, self.rlew_tag)
-        plane1 = Plane1(map, hdr.width, hdr.height)
+        plane1 = Plane1(decompress_plane(map, self.rlew_tag), hdr.width, hdr.height)
 
         map = self.gamemaps[hdr.plane2_offset : hdr.plane2_offset + hdr.plane2_len]
-        map = decompress_carmack(map)
-        map = decompress_rlew(map, self.rlew_tag)
-        plane2 = Plane2(map, hdr.width, hdr.height)
+        plane2 = Plane2(decompress_plane(map, self.rlew_tag), hdr.width, hdr.height)
 
         return Level(header=hdr, plane0=plane0, plane1=plane1, plane2=plane2)
 
@@ -742,7 +1149,7 @@ class GameAssets:
         print_header("Plane 2")
         level.plane2.print()
 
-    def load(self, path: str):
+    def load(self, path: str, cache_path: Optional[str] = None):
         logging.info("Loading MAPHEAD.WL1 (map offsets)")
         self.load_maphead(os.path.join(path, "MAPHEAD.WL1"))
 
@@ -751,3 +1158,25 @@ class GameAssets:
 
         logging.info("Loading VSWAP (textures, sprites, sounds)")
         self.load_vswap(os.path.join(path, "VSWAP.WL1"))
+
+        if cache_path is not None:
+            self.load_cache(cache_path)
+
+    def load_cache(self, path: str):
+        """
+        Use a cache of decoded arrays in the given directory. The media is
+        restored from the cache if it's there, and otherwise decoded once and
+        stored for the next start.
+        """
+        self.cache = AssetCache(
+            path, hash_files([self.maphead, self.gamemaps, self.media.vswap.data])
+        )
+        self.recent_levels.clear()
+
+        arrays = self.cache.load("media")
+        if arrays is None:
+            logging.info("Storing decoded media in %s", self.cache.path)
+            self.cache.save("media", self.media.get_arrays())
+        else:
+            logging.info("Loading decoded media from %s", self.cache.path)
+            self.media = Media.from_arrays(arrays, self.media.max_sprites)
@@ -1,13 +1,22 @@
+import heapq
 from math import pi
-from typing import Dict, List, Optional, Set
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
 
 from vargtass.game_assets import (
     BlockingObjects,
     CollectibleType,
+    DOOR_TEXTURE_HORIZONTAL,
+    DOOR_TEXTURE_VERTICAL,
     GameAssets,
+    TILE_DOOR,
+    TILE_EMPTY,
     Level,
     Tile,
 )
+from vargtass.level_loader import LevelLoader
+from vargtass.navigation import FlowField
 from vargtass.utils import rotate
 
 
@@ -25,6 +34,9 @@ class StaticObject:
     blocking: bool
     sprite: int
 
+    # Index of the object in GameState.drawables
+    drawable: int = -1
+
     def __init__(self, x: float, y: float, sprite: int, visible=True, blocking=False):
         self.x, self.y = x, y
         self.sprite = sprite
@@ -49,8 +61,215 @@ class Collectible(StaticObject):
         self.type = type
 
 
-class Actor:
-    pass
+# Kinds of actors
+ACTOR_GUARD = 0
+ACTOR_OFFICER = 1
+ACTOR_SS = 2
+ACTOR_DOG = 3
+ACTOR_MUTANT = 4
+
+# First of the eight rotations of the standing and the first walking frame of
+# each kind of actor. Dogs have no standing frames. The four walking frames
+# follow each other, eight sprites apart.
+ACTOR_STAND_SPRITE = np.array([50, 238, 138, 99, 187])
+ACTOR_WALK_SPRITE = np.array([58, 246, 146, 99, 195])
+
+# Hit points and patrol speed (tiles per second) of each kind of actor
+ACTOR_HEALTH = np.array([25, 50, 100, 1, 45])
+ACTOR_SPEED = np.array([512, 512, 512, 1500, 512]) * 70 / 65536
+
+# Walking frames per second
+ACTOR_FRAME_RATE = 70 / 20
+
+# Actor states
+ACTOR_STANDING = 0
+ACTOR_PATROLLING = 1
+
+# First plane 1 code of standing and patrolling actors of each kind, on the
+# easiest difficulty. The four codes from there face east, north, west and
+# south. Medium and hard difficulty actors follow 36 and 72 codes later,
+# except for mutants.
+ACTOR_CODES = [
+    (ACTOR_GUARD, 108, 112),
+    (ACTOR_OFFICER, 116, 120),
+    (ACTOR_SS, 126, 130),
+    (ACTOR_DOG, 134, 138),
+]
+MUTANT_CODES = [(216, 220), (234, 238), (252, 256)]
+
+# Plane 1 codes 90-97 turn patrolling actors east, northeast, north and so on
+PATH_TURN_CODES = range(90, 98)
+
+# Difficulty levels
+DIFFICULTY_BABY = 0
+DIFFICULTY_EASY = 1
+DIFFICULTY_MEDIUM = 2
+DIFFICULTY_HARD = 3
+
+
+def _actor_code_table(difficulty: int):
+    """Returns the kind, state and direction of actors by plane 1 code"""
+    kind = np.full(0x10000, -1, dtype=np.int8)
+    state = np.zeros(0x10000, dtype=np.int8)
+    dir = np.zeros(0x10000)
+
+    def add(k: int, code: int, st: int):
+        codes = np.arange(code, code + 4)
+        kind[codes] = k
+        state[codes] = st
+        dir[codes] = np.array([0, -0.5, 1, 0.5]) * pi
+
+    for tier in range(max(difficulty, 1)):
+        for k, stand, patrol in ACTOR_CODES:
+            add(k, stand + tier * 36, ACTOR_STANDING)
+            add(k, patrol + tier * 36, ACTOR_PATROLLING)
+        add(ACTOR_MUTANT, MUTANT_CODES[tier][0], ACTOR_STANDING)
+        add(ACTOR_MUTANT, MUTANT_CODES[tier][1], ACTOR_PATROLLING)
+
+    return kind, state, dir
+
+
+class Actors:
+    """
+    All actors (enemies) of a level, as one array per attribute, so that they
+    can be updated together.
+    """
+
+    kind: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+
+    # Direction the actor is facing (radians, 0 = east)
+    dir: np.ndarray
+
+    state: np.ndarray
+    health: np.ndarray
+
+    # Animation time, in frames
+    frame: np.ndarray
+
+    # Tile the actor is in, and the tile it is walking to
+    tile_x: np.ndarray
+    tile_y: np.ndarray
+    goal_x: np.ndarray
+    goal_y: np.ndarray
+
+    # Distance left to the centre of the goal tile
+    remaining: np.ndarray
+
+    # Direction that patrolling actors turn to in each tile, or NaN. Indexed
+    # by [y, x]
+    path_turns: np.ndarray
+
+    def __init__(self, codes: np.ndarray, difficulty: int = DIFFICULTY_MEDIUM):
+        """Spawn actors from the codes of plane 1, indexed by [y, x]"""
+        kinds, states, dirs = _actor_code_table(difficulty)
+        ys, xs = np.nonzero(kinds[codes] >= 0)
+        c = codes[ys, xs]
+
+        self.kind = kinds[c].astype(np.intp)
+        self.x, self.y = xs + 0.5, ys + 0.5
+        self.dir = dirs[c]
+        self.state = states[c]
+        self.health = ACTOR_HEALTH[self.kind]
+        self.frame = np.zeros(len(c))
+        self.tile_x, self.tile_y = xs.astype(np.intp), ys.astype(np.intp)
+        self.goal_x, self.goal_y = self.tile_x.copy(), self.tile_y.copy()
+        self.remaining = np.zeros(len(c))
+
+        self.path_turns = np.full(codes.shape, np.nan)
+        for i, code in enumerate(PATH_TURN_CODES):
+            self.path_turns[codes == code] = -i * pi / 4
+
+    def __len__(self):
+        return len(self.kind)
+
+    def get_sprites(self, view_x: float, view_y: float):
+        """Returns the sprite of each actor, as seen from view_x, view_y"""
+        # Actors facing the viewer use the first of the eight rotations
+        to_viewer = np.arctan2(view_y - self.y, view_x - self.x)
+        rotation = np.floor((self.dir - to_viewer + pi / 8) / (pi / 4)) % 8
+
+        walking = ACTOR_WALK_SPRITE[self.kind] + 8 * (self.frame.astype(int) % 4)
+        sprites = np.where(
+            self.state == ACTOR_PATROLLING, walking, ACTOR_STAND_SPRITE[self.kind]
+        )
+        return sprites + rotation.astype(np.intp)
+
+    def tick(self, state: "GameState", elapsed: float):
+        """Advance all actors by elapsed seconds"""
+        walking = np.flatnonzero(self.state == ACTOR_PATROLLING)
+        if len(walking) == 0:
+            return
+
+        self.frame[walking] += elapsed * ACTOR_FRAME_RATE
+
+        # Walk towards the centre of the goal tile
+        speed = ACTOR_SPEED[self.kind[walking]] * elapsed
+        step = np.clip(self.remaining[walking], 0, speed)
+        dir = self.dir[walking]
+        self.x[walking] += np.cos(dir) * step
+        self.y[walking] += np.sin(dir) * step
+        self.remaining[walking] -= speed
+
+        arrived = walking[self.remaining[walking] <= 0]
+        if len(arrived):
+            self._arrive(state, arrived)
+
+        self.tile_x[walking] = self.x[walking].astype(np.intp)
+        self.tile_y[walking] = self.y[walking].astype(np.intp)
+
+    def _arrive(self, state: "GameState", a: np.ndarray):
+        """Pick the next goal tile of patrolling actors that reached their goal"""
+        gx, gy = self.goal_x[a], self.goal_y[a]
+        self.x[a], self.y[a] = gx + 0.5, gy + 0.5
+        self.remaining[a] = 0
+
+        turn = self.path_turns[gy, gx]
+        turns = ~np.isnan(turn)
+        self.dir[a[turns]] = turn[turns]
+
+        # Walk on to the next tile if it can be entered. Closed doors are
+        # opened, and the actor waits until they are fully open. Otherwise
+        # the actor turns around.
+        dx = np.rint(np.cos(self.dir[a])).astype(np.intp)
+        dy = np.rint(np.sin(self.dir[a])).astype(np.intp)
+        h, w = state.walkable.shape
+        nx, ny = np.clip(gx + dx, 0, w - 1), np.clip(gy + dy, 0, h - 1)
+        free = state.walkable[ny, nx]
+
+        go = a[free]
+        self.goal_x[go], self.goal_y[go] = nx[free], ny[free]
+        self.remaining[go] = np.hypot(dx[free], dy[free])
+
+        doors = state.level.door_ids[ny, nx]
+        for door_id in doors[~free & (doors >= 0)].tolist():
+            if state.door_motion[door_id] == 0:
+                state.toggle_door(door_id)
+
+        turn_around = a[~free & (doors < 0)]
+        self.dir[turn_around] += pi
+
+
+class Drawables:
+    """
+    Everything that is drawn as a sprite, as one array per attribute, so
+    that all of them can be projected at once. Inactive entries, such as
+    collected collectibles, are not drawn.
+    """
+
+    x: np.ndarray
+    y: np.ndarray
+    sprite: np.ndarray
+    active: np.ndarray
+
+    def __init__(self, objects: List[StaticObject]):
+        self.x = np.array([obj.x for obj in objects], dtype=float)
+        self.y = np.array([obj.y for obj in objects], dtype=float)
+        self.sprite = np.array([obj.sprite for obj in objects], dtype=np.intp)
+        self.active = np.array([obj.visible for obj in objects], dtype=bool)
+        for i, obj in enumerate(objects):
+            obj.drawable = i
 
 
 class GameState:
@@ -65,117 +284,288 @@ class GameState:
 
     static_objects: List[StaticObject]
     collectibles: List[Collectible]
-    actors: List[Actor]
+    actors: Actors
+
+    # Difficulty, which decides which actors are spawned
+    difficulty: int = DIFFICULTY_MEDIUM
+
+    # Static objects and collectibles, in that order
+    drawables: Drawables
+
+    # Index of the static object and the collectible in each tile, indexed by
+    # [y, x], or -1 if there is none
+    static_object_tiles: np.ndarray
+    collectible_tiles: np.ndarray
+
+    # True for every tile the player can enter, indexed by [y, x]. Walls, doors
+    # that are not fully open and tiles with blocking objects are not walkable.
+    walkable: np.ndarray
+
+    # Paths from every tile to the player
+    flow_field: FlowField
 
-    # Door position identified by door ID. 0 = fully opened, 1 = fully closed
-    door_positions: Dict[int, float]
+    # Loads the levels the player is likely to enter next in the background
+    level_loader: LevelLoader
 
-    opening_doors: Set[int]
-    closing_doors: Set[int]
+    # Cost for actors of passing a door that is not fully open, compared to
+    # walking through one open tile
+    door_path_cost: float = 4.0
+
+    # Number of doors that are not fully closed between each pair of areas,
+    # indexed by [area, area]
+    area_links: np.ndarray
+
+    # Union-find forest of the areas that are connected through open doors.
+    # Parent of each area, indexed by area.
+    area_parents: List[int]
+
+    # Position of each door, indexed by door ID. 0 = fully opened, 1 = fully closed
+    door_positions: np.ndarray
+
+    # Direction each door is moving in, indexed by door ID. 1 = closing,
+    # -1 = opening and 0 = not moving
+    door_motion: np.ndarray
+
+    # Seconds an opened door stays open before it closes by itself, or None to
+    # leave doors open. Wolfenstein 3D closes doors after 300 tics at 70 Hz.
+    door_close_delay: Optional[float] = 300 / 70
+
+    # Scheduled door events as a heap of (time, door ID). Only the latest event
+    # of each door, with the time in door_timer_due, is acted on.
+    door_timers: List[Tuple[float, int]]
+    door_timer_due: np.ndarray
+
+    # Game time in seconds, advanced by update()
+    time: float = 0.0
 
     @property
     def player_dir_deg(self):
         return self.player_dir * (180 / pi)
 
+    @property
+    def opening_doors(self) -> Set[int]:
+        return set(np.flatnonzero(self.door_motion < 0).tolist())
+
+    @property
+    def closing_doors(self) -> Set[int]:
+        return set(np.flatnonzero(self.door_motion > 0).tolist())
+
     def __init__(self, assets: GameAssets):
         self.assets = assets
+        self.level_loader = LevelLoader(assets)
         self.reset()
 
     def reset(self):
-        self.door_positions = {}
-        self.opening_doors = set()
-        self.closing_doors = set()
+        self._create_doors(0)
+
+    def _create_doors(self, door_count: int):
+        # All doors start out closed
+        self.door_positions = np.ones(door_count)
+        self.door_motion = np.zeros(door_count, dtype=np.int8)
+        self.door_timers = []
+        self.door_timer_due = np.full(door_count, np.nan)
 
     def get_door_position(self, door_id):
-        try:
-            return self.door_positions[door_id]
-        except KeyError:
-            return 1.0
+        return float(self.door_positions[door_id])
+
+    def get_sprites(self):
+        """
+        Returns the position, sprite and active flag of everything that is
+        drawn as a sprite: the drawables followed by the actors.
+        """
+        d, a = self.drawables, self.actors
+        return (
+            np.concatenate((d.x, a.x)),
+            np.concatenate((d.y, a.y)),
+            np.concatenate((d.sprite, a.get_sprites(self.player_x, self.player_y))),
+            np.concatenate((d.active, np.ones(len(a), dtype=bool))),
+        )
+
+    def _in_level(self, x: int, y: int):
+        h, w = self.static_object_tiles.shape
+        return x >= 0 and x < w and y >= 0 and y < h
 
     def get_static_object_in_tile(self, x: int, y: int):
-        for obj in self.static_objects:
-            if obj.is_same_tile(x, y):
-                # There can be only one static object per tile
-                return obj
+        if self._in_level(x, y):
+            i = self.static_object_tiles[y, x]
+            if i >= 0:
+                return self.static_objects[i]
 
     def get_collectible_in_tile(self, x: int, y: int):
-        for obj in self.collectibles:
-            if obj.is_same_tile(x, y):
-                # There can be only one collectible per tile
-                return obj
+        if self._in_level(x, y):
+            i = self.collectible_tiles[y, x]
+            if i >= 0:
+                return self.collectibles[i]
+
+    def remove_static_object(self, obj: StaticObject):
+        """Remove a static object from the level, for example a destroyed prop"""
+        x, y = int(obj.x), int(obj.y)
+        if self.get_static_object_in_tile(x, y) is obj:
+            self.static_object_tiles[y, x] = -1
+        self.drawables.active[obj.drawable] = False
+        self._update_walkable(x, y)
+
+    def _index_tiles(self, objects: List, shape: tuple):
+        # There can be only one object of each kind per tile. Later objects are
+        # written first, so the first one in the list ends up in the index.
+        tiles = np.full(shape, -1, dtype=np.int32)
+        for i in reversed(range(len(objects))):
+            tiles[int(objects[i].y), int(objects[i].x)] = i
+        return tiles
 
     def _create_things(self):
         self.static_objects = []
         self.collectibles = []
+        self.drawables = Drawables([])
+        self.actors = Actors(np.zeros((0, 0), dtype=np.intp))
+        self.static_object_tiles = np.full((0, 0), -1, dtype=np.int32)
+        self.collectible_tiles = np.full((0, 0), -1, dtype=np.int32)
 
         if not self.level:
             return
 
-        for y in range(self.level.height):
-            for x in range(self.level.width):
-                t = self.level.plane1.get_cell(x, y)
-
-                if t in list(CollectibleType):
-                    self.collectibles.append(Collectible(x + 0.5, y + 0.5, t, t - 21))
-
-                elif (t >= 23 and t <= 70) or t == 124:
-                    # Props. Typically static decorations, but some block the player
-                    if t == 124:
-                        sprite = 95
-                    else:
-                        sprite = t - 21
-                    self.static_objects.append(
-                        StaticObject(
-                            x + 0.5,
-                            y + 0.5,
-                            sprite,
-                            blocking=t in list(BlockingObjects),
-                        )
-                    )
+        codes = self.level.plane1.cells
+        collectible = np.isin(codes, list(CollectibleType))
+        prop = ((codes >= 23) & (codes <= 70) | (codes == 124)) & ~collectible
+
+        for y, x in np.argwhere(collectible).tolist():
+            t = int(codes[y, x])
+            self.collectibles.append(Collectible(x + 0.5, y + 0.5, t, t - 21))
+
+        # Props. Typically static decorations, but some block the player
+        ys, xs = np.nonzero(prop)
+        t = codes[ys, xs].astype(np.intp)
+        sprites = np.where(t == 124, 95, t - 21).tolist()
+        blocking = np.isin(t, list(BlockingObjects)).tolist()
+        self.static_objects = [
+            StaticObject(x + 0.5, y + 0.5, sprite, blocking=b)
+            for x, y, sprite, b in zip(xs.tolist(), ys.tolist(), sprites, blocking)
+        ]
+
+        self.drawables = Drawables(self.static_objects + self.collectibles)
+        self.actors = Actors(codes, self.difficulty)
+
+        shape = (self.level.height, self.level.width)
+        self.static_object_tiles = self._index_tiles(self.static_objects, shape)
+        self.collectible_tiles = self._index_tiles(self.collectibles, shape)
+
+    def _prefetch_media(self):
+        """Decode the walls and sprites of the level before they are drawn"""
+        level = self.level
+        walls = np.unique(level.tile_textures[level.tile_kind != TILE_EMPTY])
+        if level.door_count:
+            # Doors are drawn with their own textures
+            doors = [DOOR_TEXTURE_HORIZONTAL, DOOR_TEXTURE_VERTICAL]
+            walls = np.union1d(walls, doors)
+
+        sprites = set(self.drawables.sprite.tolist())
+        for kind in np.unique(self.actors.kind).tolist():
+            stand, walk = ACTOR_STAND_SPRITE[kind], ACTOR_WALK_SPRITE[kind]
+            sprites.update(range(stand, stand + 8))
+            sprites.update(range(walk, walk + 32))
+
+        self.assets.media.prefetch(walls.tolist(), sorted(sprites))
+
+    def _compute_walkable(self):
+        level = self.level
+        walkable = level.tile_kind == TILE_EMPTY
+
+        doors = level.door_tiles
+        positions = [self.get_door_position(i) for i in range(level.door_count)]
+        walkable[doors[:, 0], doors[:, 1]] = np.array(positions) == 0
+
+        blocking = np.array([obj.blocking for obj in self.static_objects] + [False])
+        walkable &= ~blocking[self.static_object_tiles]
+
+        self.walkable = walkable
+
+    def _update_walkable(self, x: int, y: int):
+        """Update the walkability of one tile after a door or object changed"""
+        level = self.level
+        kind = level.tile_kind[y, x]
+        walkable = kind == TILE_EMPTY
+        if kind == TILE_DOOR:
+            walkable = self.get_door_position(int(level.door_ids[y, x])) == 0
+
+        obj = self.get_static_object_in_tile(x, y)
+        if obj and obj.blocking:
+            walkable = False
+
+        self.walkable[y, x] = walkable
+        self.flow_field.set_cost(x, y, self._get_path_cost(x, y))
+
+    def _compute_path_costs(self):
+        """Cost for actors of entering each tile, indexed by [y, x]"""
+        level = self.level
+        cost = np.where(self.walkable, 1.0, np.inf)
+        doors = (level.tile_kind == TILE_DOOR) & ~self.walkable
+        blocked = self.static_object_tiles >= 0
+        blocked[blocked] = [
+            self.static_objects[i].blocking
+            for i in self.static_object_tiles[blocked].tolist()
+        ]
+        cost[doors & ~blocked] = self.door_path_cost
+        return cost
+
+    def _get_path_cost(self, x: int, y: int):
+        if self.walkable[y, x]:
+            return 1.0
+        obj = self.get_static_object_in_tile(x, y)
+        if self.level.tile_kind[y, x] == TILE_DOOR and not (obj and obj.blocking):
+            return self.door_path_cost
+        return np.inf
 
     def enter_level(self, level_no: int):
         self.reset()
         self.level_no = level_no
-        self.level = self.assets.load_level(level_no)
+        self.level = self.level_loader.get(level_no)
+        self._create_doors(self.level.door_count)
         self._create_things()
+        self._prefetch_media()
+        self._compute_walkable()
+        self.flow_field = FlowField(self._compute_path_costs())
+        self._create_areas()
 
         spawn = self.level.get_player_spawn()
         self.player_x = spawn[0][0] + 0.5
         self.player_y = spawn[0][1] + 0.5
+        self.flow_field.set_target(spawn[0][0], spawn[0][1])
 
         print("FIXME: SPAWN POINT VIEW DIRECTION NOT USED!")
         self.player_dir = 0  # (spawn[1] + 180) * (pi / 180)
 
+        self.level_loader.prefetch(self.get_next_levels())
+
+    def get_next_levels(self):
+        """
+        Levels the player is likely to enter from the current level: the next
+        floor and the secret floor of the episode, which is the last of its
+        ten floors
+        """
+        floor = self.level_no % 10
+        episode = self.level_no - floor
+        if floor >= 8:
+            # The boss floor ends the episode, and the secret floor leads
+            # back to a floor that has been loaded before
+            return []
+        levels = [self.level_no + 1, episode + 9]
+        return [n for n in levels if self.assets.has_level(n)]
+
     def toggle_door(self, door_id: int):
         if self.level:
-            if door_id in self.opening_doors:
-                self.opening_doors.remove(door_id)
-                self.closing_doors.add(door_id)
-            elif door_id in self.closing_doors:
-                self.closing_doors.remove(door_id)
-                self.opening_doors.add(door_id)
+            motion = self.door_motion[door_id]
+            if motion != 0:
+                self.door_motion[door_id] = -motion
+            elif self.door_positions[door_id] == 0:
+                self.door_motion[door_id] = 1
             else:
-                if self.get_door_position(door_id) == 0:
-                    self.closing_doors.add(door_id)
-                else:
-                    self.opening_doors.add(door_id)
+                self.door_motion[door_id] = -1
 
     # Returns True if the tile is walkable.
-    # Walls and closed doors are not walkable.
-    # Some static objects are also blocking.
+    # Walls, doors that are not fully open and blocking objects are not walkable.
     def is_walkable(self, x: int, y: int):
         if self.level:
-            tile = self.level.tiles[y][x]
-            if tile.is_solid:
-                return False
-            if tile.is_door and self.get_door_position(tile.door_id) != 0:
-                return False
-
-            obj = self.get_static_object_in_tile(x, y)
-            if obj and obj.blocking:
-                return False
-
-            return True
+            return bool(self.walkable[y, x])
 
     def handle_open_button_press(self, tile: Tile):
         if tile.is_door:
@@ -192,6 +582,7 @@ class GameState:
         elapsed: float,
     ):
         prev_x, prev_y = int(self.player_x), int(self.player_y)
+        self.time += elapsed
 
         if left_input:
             self.player_dir -= rotation_speed * elapsed
@@ -214,7 +605,9 @@ class GameState:
         new_x, new_y = int(self.player_x), int(self.player_y)
         if not (new_x == prev_x and new_y == prev_y):
             self.enter_tile(new_x, new_y)
+            self.flow_field.set_target(new_x, new_y)
 
+        self.actors.tick(self, elapsed)
         self._update_doors(elapsed)
 
     def enter_tile(self, x: int, y: int):
@@ -222,23 +615,108 @@ class GameState:
         if c and not c.collected:
             print("TODO: Play 'collected' sound")
             c.collected = True
+            self.drawables.active[c.drawable] = False
+            self.collectible_tiles[y, x] = -1
             print(f"TODO: What to do with collected collectible? ID: {c.type}")
 
     def _update_doors(self, elapsed: float):
         # Time to open/close door fully in seconds
         spd = 0.6
 
-        if self.level:
-            for door_id in list(self.closing_doors):
-                pos = self.get_door_position(door_id) + (1 / spd) * elapsed
-                if pos >= 1:
-                    pos = 1
-                    self.closing_doors.remove(door_id)
-                self.door_positions[door_id] = pos
-
-            for door_id in list(self.opening_doors):
-                pos = self.get_door_position(door_id) - (1 / spd) * elapsed
-                if pos <= 0:
-                    pos = 0
-                    self.opening_doors.remove(door_id)
-                self.door_positions[door_id] = pos
+        if not self.level:
+            return
+
+        moving = np.flatnonzero(self.door_motion)
+        if len(moving):
+            motion = self.door_motion[moving]
+            prev = self.door_positions[moving]
+            pos = np.clip(prev + motion * ((1 / spd) * elapsed), 0, 1)
+            self.door_positions[moving] = pos
+
+            stopped = np.where(motion > 0, pos >= 1, pos <= 0)
+            self.door_motion[moving[stopped]] = 0
+
+            # Doors are only walkable when fully open, so walkability changes
+            # when a door starts closing or has opened completely
+            for door_id in moving[(prev == 0) != (pos == 0)].tolist():
+                y, x = self.level.door_tiles[door_id]
+                self._update_walkable(x, y)
+
+            # Doors connect their areas unless they are fully closed
+            linked = (prev == 1) != (pos == 1)
+            for door_id, p in zip(moving[linked].tolist(), pos[linked].tolist()):
+                self._link_areas(door_id, p < 1)
+
+            if self.door_close_delay is not None:
+                for door_id in moving[stopped & (pos == 0)].tolist():
+                    self._schedule_door(door_id, self.time + self.door_close_delay)
+
+        while self.door_timers and self.door_timers[0][0] <= self.time:
+            due, door_id = heapq.heappop(self.door_timers)
+            if due == self.door_timer_due[door_id]:
+                self.door_timer_due[door_id] = np.nan
+                self._close_opened_door(door_id)
+
+    def _create_areas(self):
+        n = self.level.area_count
+        self.area_links = np.zeros((n, n), dtype=np.int16)
+        self.area_parents = list(range(n))
+
+    def _find_area(self, area: int):
+        parents = self.area_parents
+        root = area
+        while parents[root] != root:
+            root = parents[root]
+        while parents[area] != root:
+            parents[area], area = root, parents[area]
+        return root
+
+    def _link_areas(self, door_id: int, linked: bool):
+        a, b = self.level.door_areas[door_id].tolist()
+        if a < 0 or b < 0 or a == b:
+            return
+
+        delta = 1 if linked else -1
+        self.area_links[a, b] += delta
+        self.area_links[b, a] += delta
+
+        if linked:
+            self.area_parents[self._find_area(a)] = self._find_area(b)
+        elif self.area_links[a, b] == 0:
+            # Union-find can't split sets, so rebuild it from the links that
+            # are left
+            self.area_parents = list(range(self.level.area_count))
+            for a, b in np.argwhere(np.triu(self.area_links) > 0).tolist():
+                self.area_parents[self._find_area(a)] = self._find_area(b)
+
+    def are_areas_connected(self, a: int, b: int):
+        """
+        True if sound can travel between two areas, through doors that are
+        not fully closed. Areas are numbered as in Level.areas.
+        """
+        return self._find_area(a) == self._find_area(b)
+
+    def _schedule_door(self, door_id: int, time: float):
+        self.door_timer_due[door_id] = time
+        heapq.heappush(self.door_timers, (time, door_id))
+
+    def _close_opened_door(self, door_id: int):
+        """Start closing a door that has been open for a while"""
+        if self.door_positions[door_id] != 0 or self.door_motion[door_id] != 0:
+            # The door has been toggled since it opened
+            return
+
+        y, x = self.level.door_tiles[door_id]
+        actors = self.actors
+        # Actors walking to the door tile occupy it already, like the tiles
+        # reserved in actorat in Wolf3D
+        if (
+            (x == int(self.player_x) and y == int(self.player_y))
+            or np.any((actors.tile_x == x) & (actors.tile_y == y))
+            or np.any((actors.goal_x == x) & (actors.goal_y == y))
+        ):
+            # Don't close the door on anyone, try again a bit later
+            self._schedule_door(door_id, self.time + 0.1)
+            return
+
+        self.door_motion[door_id] = 1
@@ -0,0 +1,117 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from vargtass.game_assets import GameAssets, Level
+
+
+class LevelLoader:
+    """
+    Loads levels ahead of time in a background thread, so that entering a
+    level that has been prefetched doesn't stall the game. Levels that have
+    not been prefetched are loaded synchronously.
+
+    The time it takes to get each level is recorded, along with whether it
+    had been prefetched.
+    """
+
+    assets: GameAssets
+    executor: Optional[ThreadPoolExecutor] = None
+
+    # Levels that have been prefetched or are being loaded, by level number
+    pending: Dict[int, "Future[Level]"]
+
+    # Time in seconds it took to get each level, and how many of them were
+    # ready, still being loaded in the background or not prefetched at all
+    latencies: List[float]
+    hits: int = 0
+    waits: int = 0
+    misses: int = 0
+
+    def __init__(self, assets: GameAssets):
+        self.assets = assets
+        self.pending = {}
+        self.latencies = []
+
+        # The assets cache levels in memory, which is not thread safe
+        self.lock = threading.Lock()
+
+    def _load(self, level_no: int):
+        with self.lock:
+            return self.assets.load_level(level_no)
+
+    def prefetch(self, level_nos: Iterable[int]):
+        """
+        Start loading levels in the background, unless already started.
+        Prefetched levels that are not among them are dropped.
+        """
+        level_nos = list(level_nos)
+        for level_no in list(self.pending):
+            if level_no not in level_nos:
+                self.pending.pop(level_no).cancel()
+
+        for level_no in level_nos:
+            if level_no in self.pending:
+                continue
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(1, "level-loader")
+            self.pending[level_no] = self.executor.submit(self._load, level_no)
+
+    def get(self, level_no: int) -> Level:
+        """
+        Returns a new instance of a level. Prefetched levels are handed over
+        as is, and every other level is loaded right away.
+        """
+        start = time.perf_counter()
+
+        future = self.pending.pop(level_no, None)
+        level = None
+        if future is not None:
+            if future.done():
+                self.hits += 1
+            else:
+                self.waits += 1
+            try:
+                level = future.result()
+            except Exception:
+                # Load it again below, so that the error is raised from here
+                logging.exception("Prefetching level %d failed", level_no)
+        else:
+            self.misses += 1
+
+        if level is None:
+            level = self._load(level_no)
+
+        self.latencies.append(time.perf_counter() - start)
+        logging.info(
+            "Level %d loaded in %.1f ms (%s)",
+            level_no,
+            self.latencies[-1] * 1000,
+            self.report(),
+        )
+        return level
+
+    @property
+    def hit_rate(self):
+        """Share of the levels that were ready when they were entered"""
+        total = self.hits + self.waits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        if not self.latencies:
+            return "no levels loaded"
+        mean = sum(self.latencies) / len(self.latencies)
+        return (
+            f"hit rate {self.hit_rate:.0%}, {self.hits} ready, {self.waits} waited, "
+            f"{self.misses} missed, latency mean {mean * 1000:.1f} ms, "
+            f"max {max(self.latencies) * 1000:.1f} ms"
+        )
+
+    def close(self):
+        """Stop the background thread, after the levels being loaded"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.pending.clear()
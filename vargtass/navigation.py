@@ -0,0 +1,178 @@
+import heapq
+from math import inf
+from typing import List, Optional
+
+import numpy as np
+
+
+class FlowField:
+    """
+    Shortest distance from every tile of a level to a target tile, such as
+    the tile of the player, and the tile to step to next from each tile on
+    the way there. All actors heading for the target share the same field.
+
+    Paths go between tiles sharing an edge. Entering a tile costs the cost of
+    that tile, which is infinite for tiles that can't be entered. The field
+    is refreshed lazily when it is read: a new target recomputes it from
+    scratch, while cost changes of single tiles only recompute the part of
+    the field they affect.
+    """
+
+    width: int
+    height: int
+
+    # Cost of entering each tile, indexed by [y, x]
+    cost: np.ndarray
+
+    target: Optional[int] = None
+
+    # Distance to the target and the next tile on the way there, as flat
+    # tile indices (y * width + x). The next tile is -1 for the target and
+    # for tiles that can't reach it.
+    _distance: List[float]
+    _next: List[int]
+
+    # Whether the whole field needs to be recomputed, and the tiles whose cost
+    # has changed since the last refresh otherwise
+    _dirty: bool = True
+    _changed: List[int]
+
+    def __init__(self, cost: np.ndarray):
+        self.height, self.width = cost.shape
+        self.cost = cost.astype(float)
+        self._distance = [inf] * cost.size
+        self._next = [-1] * cost.size
+        self._changed = []
+
+    def set_target(self, x: int, y: int):
+        target = y * self.width + x
+        if target != self.target:
+            self.target = target
+            self._dirty = True
+
+    def set_cost(self, x: int, y: int, cost: float):
+        if self.cost[y, x] != cost:
+            self.cost[y, x] = cost
+            if y * self.width + x == self.target:
+                # Every path ends by entering the target
+                self._dirty = True
+            elif not self._dirty:
+                # A full recompute covers every change
+                self._changed.append(y * self.width + x)
+
+    def get_distance(self, x: int, y: int):
+        self.refresh()
+        return self._distance[y * self.width + x]
+
+    def get_next_step(self, x: int, y: int):
+        """Returns the next tile on the shortest path to the target, or None"""
+        self.refresh()
+        n = self._next[y * self.width + x]
+        if n < 0:
+            return None
+        return n % self.width, n // self.width
+
+    @property
+    def distance(self):
+        """Distance to the target from every tile, indexed by [y, x]"""
+        self.refresh()
+        return np.array(self._distance).reshape(self.height, self.width)
+
+    @property
+    def next_tile(self):
+        """Flat index of the next tile from every tile, indexed by [y, x]"""
+        self.refresh()
+        return np.array(self._next).reshape(self.height, self.width)
+
+    def refresh(self):
+        if self.target is None:
+            return
+        if self._dirty:
+            self._compute()
+        elif self._changed:
+            self._update()
+        self._dirty = False
+        self._changed = []
+
+    def _neighbours(self, i: int):
+        x, y = i % self.width, i // self.width
+        if x > 0:
+            yield i - 1
+        if x < self.width - 1:
+            yield i + 1
+        if y > 0:
+            yield i - self.width
+        if y < self.height - 1:
+            yield i + self.width
+
+    def _compute(self):
+        self._distance = [inf] * self.cost.size
+        self._next = [-1] * self.cost.size
+        self._distance[self.target] = 0
+        self._propagate([(0, self.target)])
+
+    def _update(self):
+        cost = self.cost.ravel()
+        distance, next = self._distance, self._next
+
+        # Tiles that got more expensive invalidate every path through them.
+        # Find all tiles whose path leads through one of them, by following
+        # the next tiles with pointer jumping.
+        raised = self._changed
+        queue = []
+        if raised:
+            affected = np.zeros(cost.size, dtype=bool)
+            affected[raised] = True
+            parent = np.array(next)
+            parent[parent < 0] = np.flatnonzero(parent < 0)
+            while True:
+                affected |= affected[parent]
+                grand = parent[parent]
+                if np.array_equal(grand, parent):
+                    break
+                parent = grand
+
+            # Reset the affected tiles, and give them the best distance through
+            # the tiles around them that were not affected
+            tiles = np.flatnonzero(affected).tolist()
+            for i in tiles:
+                distance[i], next[i] = inf, -1
+            for i in tiles:
+                if cost[i] == inf:
+                    continue
+                for n in self._neighbours(i):
+                    d = distance[n] + cost[n]
+                    if d < distance[i]:
+                        distance[i], next[i] = d, n
+                if distance[i] < inf:
+                    queue.append((distance[i], i))
+
+        # Paths can lead through cheaper tiles from the tiles around them
+        for i in self._changed:
+            if cost[i] == inf:
+                continue
+            if distance[i] < inf:
+                queue.append((distance[i], i))
+            for n in self._neighbours(i):
+                d = distance[n] + cost[n]
+                if d < distance[i]:
+                    distance[i], next[i] = d, n
+                    queue.append((d, i))
+
+        heapq.heapify(queue)
+        self._propagate(queue)
+
+    def _propagate(self, queue: list):
+        """Dijkstra's algorithm, from the tiles in the queue"""
+        cost = self.cost.ravel().tolist()
+        distance, next = self._distance, self._next
+
+        while queue:
+            d, i = heapq.heappop(queue)
+            if d > distance[i]:
+                continue
+            d += cost[i]
+            for n in self._neighbours(i):
+                if d < distance[n] and cost[n] < inf:
+                    distance[n], next[n] = d, i
+                    heapq.heappush(queue, (d, n))
@@ -0,0 +1,259 @@
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Connection
+import os
+from typing import List, Optional
+
+import numpy as np
+
+from vargtass.game_assets import Level
+from vargtass.game_state import GameState
+from vargtass.raycaster import (
+    RAY_FIELDS,
+    Raycaster,
+    RayHits,
+    door_position_array,
+    get_ray_table,
+    trace_rays,
+)
+
+
+class SharedArray:
+    """
+    NumPy array backed by a named shared memory block. The process that
+    creates the block owns it and unlinks it when closed, other processes
+    attach to it by name.
+    """
+
+    shm: shared_memory.SharedMemory
+    array: np.ndarray
+
+    def __init__(self, shape: tuple, dtype, name: Optional[str] = None):
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+
+    @property
+    def spec(self):
+        """Arguments for attaching to the array from another process"""
+        return (self.array.shape, self.array.dtype.str, self.shm.name)
+
+    def close(self):
+        # The array must be released before the memory can be closed
+        del self.array
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _worker(conn: Connection):
+    """
+    Main loop of the worker processes. The tile grid of the level and the
+    output buffer are attached once, and every "cast" message then only
+    carries the camera and the columns to cast.
+    """
+    grid: List[SharedArray] = []
+    output: List[SharedArray] = []
+
+    while True:
+        msg = conn.recv()
+
+        if msg[0] == "cast":
+            _, index, start, end, x, y, dir, fov, width = msg[:9]
+            max_distance, solid, skip_empty = msg[9:]
+            tile_kind, textures, door_ids, blocker_distance = grid[:4]
+            door_positions, visible = grid[4:]
+            dx, dy = get_ray_table(width, fov).directions(dir)
+            hits = trace_rays(
+                tile_kind.array,
+                textures.array,
+                door_ids.array,
+                door_positions.array,
+                x,
+                y,
+                dx[start:end],
+                dy[start:end],
+                max_distance,
+                solid,
+                blocker_distance.array if skip_empty else None,
+            )
+            for (field, _), out in zip(RAY_FIELDS, output):
+                out.array[start:end] = getattr(hits, field)
+            visible.array[index] = hits.visible_tiles
+            conn.send((hits.door_rays + start, hits.door_ids, hits.steps))
+
+        elif msg[0] == "grid":
+            for a in grid:
+                a.close()
+            grid = [SharedArray(*spec) for spec in msg[1]]
+
+        elif msg[0] == "output":
+            for a in output:
+                a.close()
+            output = [SharedArray(*spec) for spec in msg[1]]
+
+        elif msg[0] == "stop":
+            break
+
+    for a in grid + output:
+        a.close()
+
+
+class ParallelRaycaster(Raycaster):
+    """
+    Raycaster that splits the columns of each frame into bands, which are
+    cast by a persistent set of worker processes. The tile arrays of the
+    level and the door positions are kept in shared memory, and the workers
+    write their hits straight into a shared output buffer, so only the
+    camera position is sent to the workers every frame.
+
+    Call close() (or use it as a context manager) to stop the workers and
+    free the shared memory.
+    """
+
+    processes: int
+    level: Optional[Level] = None
+    revision: int = 0
+    width: int = 0
+
+    def __init__(self, processes: Optional[int] = None):
+        self.processes = processes or os.cpu_count() or 1
+        self.grid: List[SharedArray] = []
+        self.output: List[SharedArray] = []
+        self.workers: List[multiprocessing.Process] = []
+        self.connections: List[Connection] = []
+
+        # Make sure the workers share the resource tracker of this process.
+        # Otherwise a worker would start its own, which unlinks the shared
+        # memory when the worker exits.
+        resource_tracker.ensure_running()
+
+        for _ in range(self.processes):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_worker, args=(worker_conn,), daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+            self.connections.append(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _send_all(self, msg: tuple):
+        for conn in self.connections:
+            conn.send(msg)
+
+    def _share_level(self, level: Level):
+        for a in self.grid:
+            a.close()
+
+        self.grid = [
+            SharedArray(level.tile_kind.shape, level.tile_kind.dtype),
+            SharedArray(level.tile_textures.shape, level.tile_textures.dtype),
+            SharedArray(level.door_ids.shape, level.door_ids.dtype),
+            SharedArray(level.blocker_distance.shape, level.blocker_distance.dtype),
+            SharedArray((max(level.door_count, 1),), np.float64),
+            SharedArray((self.processes,) + level.tile_kind.shape, bool),
+        ]
+        self.grid[0].array[:] = level.tile_kind
+        self.grid[1].array[:] = level.tile_textures
+        self.grid[2].array[:] = level.door_ids
+        self.grid[3].array[:] = level.blocker_distance
+
+        self._send_all(("grid", [a.spec for a in self.grid]))
+        self.level = level
+        self.revision = level.revision
+
+    def _share_output(self, width: int):
+        for a in self.output:
+            a.close()
+
+        self.output = [SharedArray((width,), dtype) for _, dtype in RAY_FIELDS]
+        self._send_all(("output", [a.spec for a in self.output]))
+        self.width = width
+
+    def cast_frame(
+        self,
+        state: GameState,
+        level: Level,
+        x: float,
+        y: float,
+        dir: float,
+        fov: float,
+        width: int,
+        max_distance: float = 64,
+        door_is_solid: bool = False,
+        column_step: int = 1,
+    ):
+        if column_step > 1:
+            # Sparse casting is done in a few small batches, which are not
+            # worth splitting over the workers
+            return super().cast_frame(
+                state,
+                level,
+                x,
+                y,
+                dir,
+                fov,
+                width,
+                max_distance,
+                door_is_solid,
+                column_step,
+            )
+
+        if level is not self.level or level.revision != self.revision:
+            self._share_level(level)
+        if width != self.width:
+            self._share_output(width)
+
+        self.grid[4].array[:] = door_position_array(state, level)
+
+        bands = np.linspace(0, width, self.processes + 1).astype(int)
+        for i, conn in enumerate(self.connections):
+            conn.send(
+                (
+                    "cast",
+                    i,
+                    bands[i],
+                    bands[i + 1],
+                    x,
+                    y,
+                    dir,
+                    fov,
+                    width,
+                    max_distance,
+                    door_is_solid,
+                    self.skip_empty,
+                )
+            )
+        doors = [conn.recv() for conn in self.connections]
+
+        fields = {
+            field: a.array.copy() for (field, _), a in zip(RAY_FIELDS, self.output)
+        }
+        return RayHits(
+            **fields,
+            door_rays=np.concatenate([d[0] for d in doors]),
+            door_ids=np.concatenate([d[1] for d in doors]),
+            visible_tiles=self.grid[5].array.any(axis=0),
+            steps=sum(d[2] for d in doors),
+        )
+
+    def close(self):
+        self._send_all(("stop",))
+        for worker in self.workers:
+            worker.join()
+        for a in self.grid + self.output:
+            a.close()
+        self.workers, self.connections = [], []
+        self.grid, self.output = [], []
+        self.level, self.width = None, 0
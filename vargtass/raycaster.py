@@ -1,10 +1,410 @@
-from math import floor, sqrt
+from dataclasses import dataclass
+from functools import lru_cache
+from math import cos, floor, sin, tan
 import math
 from typing import Optional
+
+import numpy as np
+
 from vargtass.game_state import GameState
-from vargtass.game_assets import Level
+from vargtass.game_assets import (
+    DOOR_TEXTURE_HORIZONTAL,
+    DOOR_TEXTURE_VERTICAL,
+    FACE_EAST,
+    FACE_NORTH,
+    FACE_SOUTH,
+    FACE_WEST,
+    TILE_DOOR,
+    TILE_SOLID,
+    Level,
+)
 from vargtass.utils import rotate
 
+# Fields of RayHits with one entry per ray, and their types
+RAY_FIELDS = (
+    ("hit", bool),
+    ("distance", np.float64),
+    ("tx", np.float64),
+    ("texture", np.intp),
+    ("face", np.int8),
+    ("hit_x", np.float64),
+    ("hit_y", np.float64),
+    ("tile_x", np.intp),
+    ("tile_y", np.intp),
+)
+
+
+@dataclass
+class RayHits:
+    """
+    Result of casting a batch of rays, one entry per ray. Entries where
+    hit is False did not hit anything within the max distance, and the
+    rest of the fields are undefined for those rays.
+    """
+
+    hit: np.ndarray
+    distance: np.ndarray
+    tx: np.ndarray
+    texture: np.ndarray
+
+    # Face of the tile that was hit (FACE_NORTH etc), or -1 for doors
+    face: np.ndarray
+
+    hit_x: np.ndarray
+    hit_y: np.ndarray
+    tile_x: np.ndarray
+    tile_y: np.ndarray
+
+    # Every door tile entered by a ray, as pairs of ray index and door id
+    door_rays: np.ndarray
+    door_ids: np.ndarray
+
+    # True for every tile that any of the rays passed through, indexed by [y, x]
+    visible_tiles: np.ndarray
+
+    # Number of grid steps taken by all rays together
+    steps: int = 0
+
+    @classmethod
+    def empty(cls, n: int, shape: tuple):
+        """Returns hits for n rays that have not hit anything, in a grid of shape"""
+        return cls(
+            **{field: np.zeros(n, dtype=dtype) for field, dtype in RAY_FIELDS},
+            door_rays=np.zeros(0, dtype=np.intp),
+            door_ids=np.zeros(0, dtype=np.intp),
+            visible_tiles=np.zeros(shape, dtype=bool),
+        )
+
+    def replace(self, rays: np.ndarray, other: "RayHits"):
+        """Replace the hits of the given rays with the hits in other"""
+        for field, _ in RAY_FIELDS:
+            getattr(self, field)[rays] = getattr(other, field)
+
+        self.steps += other.steps
+
+        # Tiles that are no longer visible are kept. This only means that some
+        # sprites may be considered unnecessarily until the cache is rebuilt.
+        self.visible_tiles |= other.visible_tiles
+
+        keep = ~np.isin(self.door_rays, rays)
+        self.door_rays = np.concatenate((self.door_rays[keep], rays[other.door_rays]))
+        self.door_ids = np.concatenate((self.door_ids[keep], other.door_ids))
+
+
+class RayTable:
+    """
+    Ray direction for every column of a viewport, relative to the view
+    direction. The rays are spread evenly over a camera plane rather than
+    by angle, which keeps straight walls straight.
+    """
+
+    width: int
+    fov: float
+
+    # Offset of each column along the camera plane, which is at distance 1
+    offset: np.ndarray
+
+    # Length of the (1, offset) vector. The projected (perpendicular) distance
+    # of a hit is the distance along the ray divided by this.
+    length: np.ndarray
+
+    # Normalized ray directions, with the view direction along the X axis
+    forward: np.ndarray
+    side: np.ndarray
+
+    def __init__(self, width: int, fov: float):
+        self.width, self.fov = width, fov
+        self.offset = (2 * np.arange(width) / width - 1) * tan(fov)
+        self.length = np.sqrt(1 + self.offset**2)
+        self.forward = 1 / self.length
+        self.side = self.offset / self.length
+
+    def directions(self, dir: float):
+        """Returns the normalized ray directions with the view rotated by dir"""
+        c, s = cos(dir), sin(dir)
+        return c * self.forward - s * self.side, s * self.forward + c * self.side
+
+
+@lru_cache(maxsize=8)
+def get_ray_table(width: int, fov: float):
+    """Returns the ray table for the viewport, only building it when it changes"""
+    return RayTable(width, fov)
+
+
+def door_position_array(state: GameState, level: Level):
+    """Door positions of the state, indexed by door id, with at least one entry"""
+    if level.door_count == 0:
+        return np.ones(1)
+    return state.door_positions
+
+
+def _ray_params(x: float, y: float, dx: np.ndarray, dy: np.ndarray):
+    """
+    Starting state of rays from x, y, given as normalized direction vectors.
+    The state of a ray after passing n vertical grid lines is
+
+        length = v_length0 + n * v_step_length
+        x = v_x0 + n * v_step
+        y = v_y0 + n * v_step_y
+
+    and likewise for horizontal grid lines.
+    """
+    fx, fy = x % 1, y % 1
+
+    # Same state as in _prepare(), but with one entry per ray. The slope is how
+    # far the ray moves along the other axis for every unit step. Rays that never
+    # cross vertical (or horizontal) grid lines start at infinite length and do
+    # not move along that axis.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        v_slope = np.where(dx != 0, dy / dx, 0)
+        h_slope = np.where(dy != 0, dx / dy, 0)
+        v_step_length = np.where(dx != 0, 1 / np.abs(dx), 0)
+        h_step_length = np.where(dy != 0, 1 / np.abs(dy), 0)
+
+    v_step = np.where(dx < 0, -1, 1)
+    v_length0 = np.where(dx < 0, fx, 1.0 - fx) * v_step_length
+    v_length0[dx == 0] = np.inf
+    v_x0 = np.where(dx < 0, floor(x), floor(x + 1)).astype(float)
+    v_y0 = np.where(dx < 0, y - fx * v_slope, y + (1.0 - fx) * v_slope)
+    v_step_y = v_slope * v_step
+
+    h_step = np.where(dy < 0, -1, 1)
+    h_length0 = np.where(dy < 0, fy, 1.0 - fy) * h_step_length
+    h_length0[dy == 0] = np.inf
+    h_x0 = np.where(dy < 0, x - fy * h_slope, x + (1.0 - fy) * h_slope)
+    h_y0 = np.where(dy < 0, floor(y), floor(y + 1)).astype(float)
+    h_step_x = h_slope * h_step
+
+    return (
+        (v_step, v_length0, v_step_length, v_x0, v_y0, v_step_y),
+        (h_step, h_length0, h_step_length, h_x0, h_y0, h_step_x),
+    )
+
+
+def trace_rays(
+    tile_kind: np.ndarray,
+    textures: np.ndarray,
+    door_ids: np.ndarray,
+    door_positions: np.ndarray,
+    x: float,
+    y: float,
+    dx: np.ndarray,
+    dy: np.ndarray,
+    max_distance: float = 64,
+    door_is_solid: bool = False,
+    blocker_distance: Optional[np.ndarray] = None,
+):
+    """
+    Trace rays from x, y through a tile grid, given as the tile arrays of a
+    level and the door positions indexed by door id. All rays are stepped
+    through the grid in lockstep.
+
+    If the blocker distance field of the level is given, rays leap across
+    open space instead of stepping one tile at a time. The hits are exactly
+    the same either way.
+    """
+    n = len(dx)
+    v_params, h_params = _ray_params(x, y, dx, dy)
+    v_step, v_length0, v_step_length, v_x0, v_y0, v_step_y = v_params
+    h_step, h_length0, h_step_length, h_x0, h_y0, h_step_x = h_params
+
+    # Number of vertical and horizontal grid lines each ray has passed. The ray
+    # state is computed from these, rather than accumulated, so that skipping
+    # ahead gives the same result as taking every step.
+    v_count = np.zeros(n)
+    h_count = np.zeros(n)
+
+    hits = RayHits.empty(n, tile_kind.shape)
+    hits.visible_tiles[floor(y), floor(x)] = True
+    door_rays, door_ids_crossed = [], []
+
+    # Tiles passed by skipping ahead, marked as corners of boxes in a difference
+    # array that is summed up at the end
+    skipped = np.zeros((tile_kind.shape[0] + 1, tile_kind.shape[1] + 1))
+
+    # All rays take one step per iteration, through the nearest of their vertical
+    # and horizontal grid intersections. Rays that hit something or reach the max
+    # distance are dropped from the state arrays.
+    rays = np.arange(n)
+    while len(rays):
+        hits.steps += len(rays)
+
+        v_length = v_length0 + v_count * v_step_length
+        h_length = h_length0 + h_count * h_step_length
+        use_v = v_length < h_length
+        length = np.where(use_v, v_length, h_length)
+        hit_x = np.where(use_v, v_x0 + v_count * v_step, h_x0 + h_count * h_step_x)
+        hit_y = np.where(use_v, v_y0 + v_count * v_step_y, h_y0 + h_count * h_step)
+
+        cell_x = np.floor(hit_x).astype(np.intp) - (use_v & (v_step < 0))
+        cell_y = np.floor(hit_y).astype(np.intp) - (~use_v & (h_step < 0))
+
+        hits.visible_tiles[cell_y, cell_x] = True
+
+        kind = tile_kind[cell_y, cell_x]
+        is_door = kind == TILE_DOOR
+        is_wall = kind == TILE_SOLID
+
+        if is_door.any():
+            door_rays.append(rays[is_door])
+            door_ids_crossed.append(door_ids[cell_y[is_door], cell_x[is_door]])
+
+        if door_is_solid:
+            is_wall = is_wall | is_door
+
+        if is_wall.any():
+            w = is_wall
+            face = np.where(use_v[w], 2 + v_step[w], 1 - h_step[w])
+            r = rays[w]
+            hits.hit[r] = True
+            hits.distance[r] = length[w]
+            hits.tx[r] = np.where(use_v[w], hit_y[w], hit_x[w]) % 1
+            hits.texture[r] = textures[cell_y[w], cell_x[w], face]
+            hits.face[r] = face
+            hits.hit_x[r], hits.hit_y[r] = hit_x[w], hit_y[w]
+            hits.tile_x[r], hits.tile_y[r] = cell_x[w], cell_y[w]
+
+        is_door &= ~is_wall
+        if is_door.any():
+            # Doors are tested half a step further in, in the middle of the tile
+            d = np.flatnonzero(is_door)
+            v = use_v[d]
+            door_x = np.where(v, hit_x[d] + v_step[d] / 2, hit_x[d] + h_step_x[d] / 2)
+            door_y = np.where(v, hit_y[d] + v_step_y[d] / 2, hit_y[d] + h_step[d] / 2)
+            door_hit = np.where(v, door_y - cell_y[d], door_x - cell_x[d])
+            door_pos = door_positions[door_ids[cell_y[d], cell_x[d]]]
+            closed = (door_hit >= 0) & (door_hit < 1) & (door_hit < door_pos)
+            d, v = d[closed], v[closed]
+            is_door[:] = False
+            is_door[d] = True
+
+            step_length = np.where(v, v_step_length[d], h_step_length[d])
+            r = rays[d]
+            hits.hit[r] = True
+            hits.distance[r] = length[d] + step_length / 2
+            hits.tx[r] = (door_pos[closed] - door_hit[closed]) % 1
+            hits.texture[r] = np.where(
+                v, DOOR_TEXTURE_VERTICAL, DOOR_TEXTURE_HORIZONTAL
+            )
+            hits.face[r] = -1
+            hits.hit_x[r], hits.hit_y[r] = door_x[closed], door_y[closed]
+            hits.tile_x[r], hits.tile_y[r] = cell_x[d], cell_y[d]
+
+        v_count += use_v
+        h_count += ~use_v
+
+        keep = ~(is_wall | is_door) & (length < max_distance)
+
+        if blocker_distance is not None:
+            # No blocker is closer than k tiles (Chebyshev distance) from the tile
+            # the ray just entered, so all grid lines passed within the next k - 1
+            # units lead into empty tiles. They are skipped, except for those at or
+            # beyond the max distance, which must end the ray the same way as when
+            # stepping. Skipping a single tile is not worth the overhead.
+            k = blocker_distance[cell_y, cell_x]
+            s = np.flatnonzero(keep & (k > 2))
+            if len(s):
+                reach = np.minimum(length[s] + (k[s] - 1), max_distance) - 1e-9
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    v_skip = np.ceil((reach - v_length0[s]) / v_step_length[s])
+                    h_skip = np.ceil((reach - h_length0[s]) / h_step_length[s])
+                v_count[s] = np.fmax(v_count[s], v_skip)
+                h_count[s] = np.fmax(h_count[s], h_skip)
+
+                # The tiles passed are within the bounding box of the skipped
+                # part of the ray
+                rx, ry = dx[rays[s]], dy[rays[s]]
+                ax, bx = x + length[s] * rx, x + reach * rx
+                ay, by = y + length[s] * ry, y + reach * ry
+                x0 = np.floor(np.minimum(ax, bx)).astype(np.intp)
+                x1 = np.floor(np.maximum(ax, bx)).astype(np.intp) + 1
+                y0 = np.floor(np.minimum(ay, by)).astype(np.intp)
+                y1 = np.floor(np.maximum(ay, by)).astype(np.intp) + 1
+                stride = skipped.shape[1]
+                corners = np.concatenate(
+                    (
+                        y0 * stride + x0,
+                        y1 * stride + x1,
+                        y0 * stride + x1,
+                        y1 * stride + x0,
+                    )
+                )
+                weights = np.repeat([1, 1, -1, -1], len(s))
+                skipped += np.bincount(corners, weights, skipped.size).reshape(
+                    skipped.shape
+                )
+
+        if not keep.all():
+            rays = rays[keep]
+            v_count, h_count = v_count[keep], h_count[keep]
+            v_length0, v_x0, v_y0 = v_length0[keep], v_x0[keep], v_y0[keep]
+            h_length0, h_x0, h_y0 = h_length0[keep], h_x0[keep], h_y0[keep]
+            v_step, v_step_y = v_step[keep], v_step_y[keep]
+            h_step, h_step_x = h_step[keep], h_step_x[keep]
+            v_step_length = v_step_length[keep]
+            h_step_length = h_step_length[keep]
+
+    if blocker_distance is not None:
+        skipped = skipped.cumsum(axis=0).cumsum(axis=1)
+        hits.visible_tiles |= skipped[:-1, :-1] > 0.5
+
+    if door_rays:
+        hits.door_rays = np.concatenate(door_rays)
+        hits.door_ids = np.concatenate(door_ids_crossed).astype(np.intp)
+
+    return hits
+
+
+class HitCache:
+    """
+    Keeps the hits of the previous frame, so that they can be reused as long
+    as the camera does not move and no tiles change. If only some doors have
+    moved since then, only the rays that passed through those doors are cast
+    again.
+    """
+
+    key: Optional[tuple] = None
+    hits: Optional[RayHits] = None
+
+    # Door positions at the time of the cached hits
+    door_positions: np.ndarray
+
+    def __init__(self):
+        self.door_positions = np.zeros(0)
+
+    def cast_frame(
+        self,
+        raycaster: "Raycaster",
+        state: GameState,
+        level: Level,
+        x: float,
+        y: float,
+        dir: float,
+        fov: float,
+        width: int,
+        column_step: int = 1,
+    ):
+        key = (level, level.revision, x, y, dir, fov, width, column_step)
+        if self.hits is None or key != self.key:
+            self.key = key
+            self.hits = raycaster.cast_frame(
+                state, level, x, y, dir, fov, width, column_step=column_step
+            )
+            self.door_positions = state.door_positions.copy()
+            return self.hits
+
+        moved = np.flatnonzero(self.door_positions != state.door_positions)
+
+        if len(moved):
+            rays = np.unique(self.hits.door_rays[np.isin(self.hits.door_ids, moved)])
+            if len(rays):
+                dx, dy = get_ray_table(width, fov).directions(dir)
+                hits = raycaster.cast_rays(state, level, x, y, dx[rays], dy[rays])
+                self.hits.replace(rays, hits)
+            self.door_positions = state.door_positions.copy()
+
+        return self.hits
+
 
 class Raycaster:
     # Camera position
@@ -17,6 +417,10 @@ class Raycaster:
     # Max distance before raycasting stops
     max_distance = 64
 
+    # Use the blocker distance field of the level to leap across open space
+    # when casting rays in batches
+    skip_empty = True
+
     # State for testing horizontal walls
     hray_step_length: float
     hray_step_x: float
@@ -47,10 +451,10 @@ class Raycaster:
         self.vray_step_y = dy / dx if dx != 0 else math.inf
 
         # How much longer the ray gets for each unit step along the X axis
-        self.vray_step_length = sqrt(1 + (dy / dx) ** 2) if dx != 0 else math.inf
+        self.vray_step_length = 1 / abs(dx) if dx != 0 else math.inf
 
         # How much longer the ray gets for each unit step along the Y axis
-        self.hray_step_length = sqrt(1 + (dx / dy) ** 2) if dy != 0 else math.inf
+        self.hray_step_length = 1 / abs(dy) if dy != 0 else math.inf
 
         if dx < 0:
             self.vray_step_x = -1
@@ -91,6 +495,8 @@ class Raycaster:
 
         self._prepare()
 
+        tile_kind, tile_textures = level.tile_kind, level.tile_textures
+
         distance = 0
         tx = 0
         while distance < max_distance:
@@ -101,25 +507,26 @@ class Raycaster:
                 cell_y = floor(hit_y)
                 wall_index_add = -1
 
-                tile = level.tiles[cell_y][cell_x]
+                kind = tile_kind[cell_y, cell_x]
 
-                if tile.is_solid or (tile.is_door and door_is_solid):
-                    if self.vray_step_x > 0:
-                        texture = tile.get_texture_west()
-                    else:
-                        texture = tile.get_texture_east()
+                if kind == TILE_SOLID or (kind == TILE_DOOR and door_is_solid):
+                    face = FACE_WEST if self.vray_step_x > 0 else FACE_EAST
+                    texture = int(tile_textures[cell_y, cell_x, face])
+                    tile = level.get_tile(cell_x, cell_y)
 
                     tx = hit_y % 1
                     return (distance, tx, texture, (hit_x, hit_y), tile)
 
-                if tile.is_door:
+                if kind == TILE_DOOR:
                     door_hit_x = hit_x + self.vray_step_x / 2
                     door_hit = (
                         hit_y + (self.vray_step_y * self.vray_step_x) / 2
                     ) - cell_y
 
                     if door_hit >= 0 and door_hit < 1:
-                        door_position = state.get_door_position(tile.door_id)
+                        door_position = state.get_door_position(
+                            int(level.door_ids[cell_y, cell_x])
+                        )
                         door_hit_y = hit_y + (self.vray_step_x * self.vray_step_y) / 2
                         tx = (door_position - door_hit) % 1
                         if (door_hit) < door_position:
@@ -128,7 +535,7 @@ class Raycaster:
                                 tx,
                                 100 + wall_index_add,
                                 (door_hit_x, door_hit_y),
-                                tile,
+                                level.get_tile(cell_x, cell_y),
                             )
 
                 self.vray_length += self.vray_step_length
@@ -141,25 +548,26 @@ class Raycaster:
                 cell_y = floor(hit_y) if self.hray_step_y > 0 else floor(hit_y - 1)
                 wall_index_add = -2
 
-                tile = level.tiles[cell_y][cell_x]
+                kind = tile_kind[cell_y, cell_x]
 
-                if tile.is_solid or (tile.is_door and door_is_solid):
-                    if self.hray_step_y > 0:
-                        texture = tile.get_texture_north()
-                    else:
-                        texture = tile.get_texture_south()
+                if kind == TILE_SOLID or (kind == TILE_DOOR and door_is_solid):
+                    face = FACE_NORTH if self.hray_step_y > 0 else FACE_SOUTH
+                    texture = int(tile_textures[cell_y, cell_x, face])
+                    tile = level.get_tile(cell_x, cell_y)
 
                     tx = hit_x % 1
                     return (distance, tx, texture, (hit_x, hit_y), tile)
 
-                if tile.is_door:
+                if kind == TILE_DOOR:
                     door_hit_y = hit_y + self.hray_step_y / 2
                     door_hit = (
                         hit_x + (self.hray_step_y * self.hray_step_x) / 2
                     ) - cell_x
 
                     if door_hit >= 0 and door_hit < 1:
-                        door_position = state.get_door_position(tile.door_id)
+                        door_position = state.get_door_position(
+                            int(level.door_ids[cell_y, cell_x])
+                        )
                         door_hit_x = hit_x + (self.hray_step_y * self.hray_step_x) / 2
                         tx = (door_position - door_hit) % 1
                         if (door_hit) < door_position:
@@ -168,7 +576,7 @@ class Raycaster:
                                 tx,
                                 100 + wall_index_add,
                                 (door_hit_x, door_hit_y),
-                                tile,
+                                level.get_tile(cell_x, cell_y),
                             )
 
                 self.hray_length += self.hray_step_length
@@ -176,3 +584,178 @@ class Raycaster:
                 self.hray_y += self.hray_step_y
 
         return None
+
+    def cast_frame(
+        self,
+        state: GameState,
+        level: Level,
+        x: float,
+        y: float,
+        dir: float,
+        fov: float,
+        width: int,
+        max_distance: float = 64,
+        door_is_solid: bool = False,
+        column_step: int = 1,
+    ):
+        """
+        Cast one ray per screen column, spread over the camera plane from
+        dir - fov to dir + fov, and return the hits as arrays.
+
+        With a column_step above 1, only every column_step:th column is cast
+        at first, and the columns in between are filled in from the walls hit
+        by the casted columns where possible. See _cast_sparse().
+        """
+        dx, dy = get_ray_table(width, fov).directions(dir)
+        if column_step > 1:
+            return self._cast_sparse(
+                state, level, x, y, dx, dy, column_step, max_distance, door_is_solid
+            )
+        return self.cast_rays(
+            state, level, x, y, dx, dy, max_distance, door_is_solid=door_is_solid
+        )
+
+    def _cast_sparse(
+        self,
+        state: GameState,
+        level: Level,
+        x: float,
+        y: float,
+        dx: np.ndarray,
+        dy: np.ndarray,
+        column_step: int,
+        max_distance: float,
+        door_is_solid: bool,
+    ):
+        """
+        Cast every column_step:th ray, and the last one. When two neighbouring
+        samples hit the same face of the same tile without passing through a
+        door, the rays in between are assumed to hit that face too, and the hit
+        is computed directly from where the ray crosses the grid line of the
+        face, the same way trace_rays() computes it. All other rays in between
+        are cast as usual.
+
+        The only case where the result differs from casting every ray is when
+        the corner of another tile pokes in between two samples, without being
+        touched by either of them.
+        """
+        width = len(dx)
+        samples = np.unique(np.append(np.arange(0, width, column_step), width - 1))
+        hits = RayHits.empty(width, level.tile_kind.shape)
+        hits.replace(
+            samples,
+            self.cast_rays(
+                state,
+                level,
+                x,
+                y,
+                dx[samples],
+                dy[samples],
+                max_distance,
+                door_is_solid,
+            ),
+        )
+
+        crossed_door = np.zeros(width, dtype=bool)
+        crossed_door[hits.door_rays] = True
+
+        a, b = samples[:-1], samples[1:]
+        smooth = (
+            hits.hit[a]
+            & hits.hit[b]
+            & (hits.face[a] >= 0)
+            & (hits.face[a] == hits.face[b])
+            & (hits.tile_x[a] == hits.tile_x[b])
+            & (hits.tile_y[a] == hits.tile_y[b])
+            & ~crossed_door[a]
+            & ~crossed_door[b]
+        )
+
+        # Columns between the samples, and the sample to the left of each
+        gaps = b - a - 1
+        source = np.repeat(a, gaps)
+        columns = (
+            source
+            + 1
+            + np.arange(len(source))
+            - np.repeat(np.cumsum(gaps) - gaps, gaps)
+        )
+        filled = np.repeat(smooth, gaps)
+
+        rest = columns[~filled]
+        if len(rest):
+            hits.replace(
+                rest,
+                self.cast_rays(
+                    state,
+                    level,
+                    x,
+                    y,
+                    dx[rest],
+                    dy[rest],
+                    max_distance,
+                    door_is_solid,
+                ),
+            )
+
+        c, s = columns[filled], source[filled]
+        if len(c):
+            v_params, h_params = _ray_params(x, y, dx[c], dy[c])
+            v_step, v_length0, v_step_length, v_x0, v_y0, v_step_y = v_params
+            h_step, h_length0, h_step_length, h_x0, h_y0, h_step_x = h_params
+
+            # East and west faces lie on vertical grid lines, north and south
+            # faces on horizontal ones. Count the grid lines the ray passes
+            # before reaching the face, the same way trace_rays() does.
+            use_v = (hits.face[s] == FACE_EAST) | (hits.face[s] == FACE_WEST)
+            with np.errstate(invalid="ignore"):
+                v_count = (hits.hit_x[s] - v_x0) * v_step
+                h_count = (hits.hit_y[s] - h_y0) * h_step
+                hit_x = np.where(
+                    use_v, v_x0 + v_count * v_step, h_x0 + h_count * h_step_x
+                )
+                hit_y = np.where(
+                    use_v, v_y0 + v_count * v_step_y, h_y0 + h_count * h_step
+                )
+                hits.distance[c] = np.where(
+                    use_v,
+                    v_length0 + v_count * v_step_length,
+                    h_length0 + h_count * h_step_length,
+                )
+            hits.hit[c] = True
+            hits.tx[c] = np.where(use_v, hit_y, hit_x) % 1
+            hits.hit_x[c], hits.hit_y[c] = hit_x, hit_y
+            for field in ("texture", "face", "tile_x", "tile_y"):
+                getattr(hits, field)[c] = getattr(hits, field)[s]
+
+        return hits
+
+    def cast_rays(
+        self,
+        state: GameState,
+        level: Level,
+        x: float,
+        y: float,
+        dx: np.ndarray,
+        dy: np.ndarray,
+        max_distance: float = 64,
+        door_is_solid: bool = False,
+    ):
+        """
+        Vectorized version of raycast() for any number of rays starting at x, y,
+        given as normalized direction vectors. The results are the same as
+        calling raycast() once for every direction.
+        """
+        return trace_rays(
+            level.tile_kind,
+            level.tile_textures,
+            level.door_ids,
+            door_position_array(state, level),
+            x,
+            y,
+            dx,
+            dy,
+            max_distance,
+            door_is_solid,
+            level.blocker_distance if self.skip_empty else None,
+        )
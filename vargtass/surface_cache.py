@@ -0,0 +1,55 @@
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+import pygame
+
+
+def quantize_size(size: int):
+    """
+    Round a size in pixels to one of a limited set of sizes. Sizes below 128
+    are kept as is, and larger sizes are rounded to a step of at most 1/64 of
+    the size.
+    """
+    step = 1 << max(0, size.bit_length() - 7)
+    return (size + step // 2) // step * step
+
+
+class SurfaceCache:
+    """
+    Least recently used cache of surfaces, such as pre-scaled textures. The
+    oldest surfaces are dropped when the total size of the pixels exceeds
+    max_bytes.
+    """
+
+    max_bytes: int
+    size: int = 0
+    hits: int = 0
+    misses: int = 0
+
+    surfaces: "OrderedDict[Hashable, pygame.Surface]"
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.surfaces = OrderedDict()
+
+    def get(self, key: Hashable, make: Callable[[], pygame.Surface]):
+        """Returns the surface cached for key, or makes and caches it"""
+        try:
+            surf = self.surfaces[key]
+        except KeyError:
+            self.misses += 1
+            surf = make()
+            self.surfaces[key] = surf
+            self.size += surf.get_pitch() * surf.get_height()
+            while self.size > self.max_bytes and len(self.surfaces) > 1:
+                _, old = self.surfaces.popitem(last=False)
+                self.size -= old.get_pitch() * old.get_height()
+            return surf
+
+        self.hits += 1
+        self.surfaces.move_to_end(key)
+        return surf
+
+    def clear(self):
+        self.surfaces.clear()
+        self.size = 0